@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import importlib.util
+
 from .scm import ScmCollection as ns
 from .bootstrap import BootstrapCollection
 from .config import ConfigCollection
@@ -7,10 +9,8 @@ from .tryton import TrytonCollection
 from .patches import QuiltCollection
 from .sao import SaoCollection
 
-try:
-    import trytond
-except ImportError:
-    trytond = None
+# Only check trytond is available, it is imported when a task needs it
+trytond = importlib.util.find_spec('trytond')
 
 ns.add_collection(BootstrapCollection, 'bs')
 ns.add_collection(UtilsCollection, 'utils')
@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 
 import configparser
+import hashlib
+import multiprocessing
 import os
-from blessings import Terminal
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from invoke import Collection, task, run
 from path import Path
 
-from .utils import _ask_ok, _check_required_file, _exit
-from .scm import git_clone, git_pull, clone, fetch
+from .utils import (t, _ask, _ask_ok, _check_required_file, _exit,
+    read_config_file, build_wheelhouse, get_wheelhouse,
+    install_requirements_offline, get_requirements_files)
+from .scm import git_clone, git_pull, clone, fetch, pull, get_repo
 from .sao import install as sao_install, grunt as sao_grunt
 
 
-t = Terminal()
 Config = configparser.ConfigParser()
 
 # TODO: l'us que faig del config potser correspon a context
@@ -19,6 +23,9 @@ Config = configparser.ConfigParser()
 
 INITIAL_PATH = Path.getcwd()
 
+LOCK_FILE = 'tryton.lock'
+REQUIREMENTS_LOCK_FILE = 'requirements.lock'
+
 
 @task()
 def get_tasks(ctx, taskpath='tasks'):
@@ -106,7 +113,7 @@ def install_requirements(ctx, upgrade=False):
     if not Config.requirements:
         return
     if not hasattr(Config, 'virtualenv_active') and os.geteuid() != 0:
-        resp = input('It can\'t install requirements because you aren\'t '
+        resp = _ask('It can\'t install requirements because you aren\'t '
             'the Root user and you aren\'t in a Virtualenv. You will have to '
             'install requirements manually as root with command:\n'
             '  $ pip install [--upgrade] -r requirements.txt\n'
@@ -127,11 +134,84 @@ def install_requirements(ctx, upgrade=False):
             % Config.config_path)
         #    _out=options.output, _err=sys.stderr)
     else:
-        run('pip install -r %s/requirements.txt' % Config.config_path)
-        #    _out=options.output, _err=sys.stderr)
+        # Install the same files as fetch so it finds them installed
+        requirements_files = get_requirements_files()
+        config_requirements = str(Config.config_path.joinpath(
+                'requirements.txt'))
+        if os.path.abspath(config_requirements) not in [
+                os.path.abspath(x) for x in requirements_files]:
+            requirements_files.insert(0, config_requirements)
+        install_requirements_offline(requirements_files)
     print("")
 
 
+def lock_requirements(requirements_lockfile=REQUIREMENTS_LOCK_FILE):
+    """
+    Build the wheelhouse of the requirements and write the versions and
+    hashes of its wheels to requirements_lockfile.
+    """
+    key = build_wheelhouse()
+    if not key:
+        _exit(INITIAL_PATH, "It's not possible to build the wheelhouse")
+    wheelhouse = get_wheelhouse(key)
+
+    # The wheelhouse is recorded so the lock can be installed from it even
+    # if the requirements files change later
+    lines = ['# wheelhouse: %s' % key]
+    for name in sorted(os.listdir(wheelhouse)):
+        if not name.endswith('.whl'):
+            continue
+        package, version = name.split('-')[:2]
+        with open(os.path.join(wheelhouse, name), 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        lines.append('%s==%s --hash=sha256:%s' % (package, version, digest))
+
+    with open(requirements_lockfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def install_locked_requirements(requirements_lockfile=REQUIREMENTS_LOCK_FILE):
+    """
+    Install the locked requirements from the wheelhouse without using the
+    network.
+    """
+    with open(requirements_lockfile) as f:
+        key = f.readline().split(':', 1)[1].strip()
+    print('Installing locked dependencies.')
+    run('pip install --no-index --find-links %s --require-hashes -r %s'
+        % (get_wheelhouse(key), requirements_lockfile))
+
+
+@task()
+def lock(ctx, config=None, lockfile=LOCK_FILE,
+        requirements_lockfile=REQUIREMENTS_LOCK_FILE):
+    '''
+    Write the current revision of each repository to lockfile and the
+    versions and hashes of the requirements to requirements_lockfile.
+
+    Both are used by "bootstrap --lockfile" to build the same environment
+    without prompts.
+    '''
+    Config = read_config_file(config)
+    Lock = configparser.ConfigParser()
+    for section in Config.sections():
+        repo = get_repo(section, Config, 'revision')
+        revision = repo['function'](section, repo['path'], verbose=False)
+        if not revision:
+            continue
+        Lock.add_section(section)
+        Lock.set(section, 'repo', repo['type'])
+        Lock.set(section, 'url', repo['url'])
+        Lock.set(section, 'path', Config.get(section, 'path'))
+        Lock.set(section, 'branch', repo['branch'])
+        Lock.set(section, 'revision', revision)
+    with open(lockfile, 'w') as f:
+        Lock.write(f)
+
+    lock_requirements(requirements_lockfile)
+    print(t.bold('Locked %d repositories' % len(Lock.sections())))
+
+
 # TODO: prepare_local() => set configuration options for future bootstrap based
 # on Config values
 
@@ -155,15 +235,87 @@ def install_proteus(ctx, proteuspath=None, upgrade=False):
     print("")
 
 
+def run_stages(stages):
+    """
+    Run each stage as soon as the stages it depends on have finished, so
+    independent stages run concurrently.
+
+    stages is a list of (name, dependencies, function) tuples. Returns a
+    dict with the (start, end) times of each stage.
+    """
+    times = {}
+
+    def _run(name, function):
+        start = time.time()
+        function()
+        times[name] = (start, time.time())
+
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for stage in pending[:]:
+                name, dependencies, function = stage
+                if all(d in times for d in dependencies):
+                    pending.remove(stage)
+                    running[executor.submit(_run, name, function)] = name
+            if not running:
+                _exit(INITIAL_PATH, 'Unresolved bootstrap stages: %s'
+                    % ', '.join(x[0] for x in pending))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                # Raise the exception of failed stages
+                future.result()
+    return times
+
+
+def print_critical_path(stages, times):
+    """
+    Print the duration of each stage and the chain of stages that
+    determined the total time.
+    """
+    dependencies = dict((name, deps) for name, deps, _ in stages)
+    name = max(times, key=lambda x: times[x][1])
+    critical = []
+    while name:
+        critical.insert(0, name)
+        name = max(dependencies[name], key=lambda x: times[x][1],
+            default=None)
+
+    start = min(x[0] for x in times.values())
+    print(t.bold('Bootstrap stages:'))
+    for name, _, _ in stages:
+        stage_start, stage_end = times[name]
+        print('  %s %-20s %8.2fs (from %.2fs to %.2fs)' % (
+                '*' if name in critical else ' ', name,
+                stage_end - stage_start, stage_start - start,
+                stage_end - start))
+    print(t.bold('Critical path: ') + ' -> '.join(critical)
+        + ' (%.2fs)' % (times[critical[-1]][1] - start))
+
+
 @task(default=True)
 def bootstrap(ctx, branch, projectpath='', projectname='',
         taskspath='tasks',
         configpath='config',
         utilspath='utils',
         virtualenv=True,
-        upgradereqs=False):
+        upgradereqs=False,
+        lockfile=None,
+        requirements_lockfile=REQUIREMENTS_LOCK_FILE,
+        noninteractive=False):
+    '''
+    Prepare the project: get tasks and config, install requirements, clone
+    and fetch the repositories and build SAO.
 
-    cwd = Path.getcwd()
+    With lockfile (see the lock task) the repositories are cloned and
+    updated to the locked revisions and the requirements are installed
+    from the wheelhouse. It implies noninteractive, which uses the default
+    answer instead of asking.
+    '''
+    if lockfile or noninteractive:
+        os.environ['TRYTON_TASKS_NONINTERACTIVE'] = '1'
 
     if projectpath:
         projectpath = Path(projectpath)
@@ -185,25 +337,44 @@ def bootstrap(ctx, branch, projectpath='', projectname='',
     Config.get_config = True
     Config.requirements = True  # Install?
 
-    get_tasks(ctx, taskspath)
-    get_config(ctx, configpath, branch=branch)
-    activate_virtualenv(ctx, projectname)
-    install_requirements(ctx, upgrade=upgradereqs)
-
-    clone(ctx, 'config/base.cfg')
-    fetch(ctx)
-
-    # SAO
-    sao_install(ctx)
-    os.chdir(cwd)
-    sao_grunt(ctx)
+    stages = [
+        ('tasks', [], lambda: get_tasks(ctx, taskspath)),
+        ('config', ['tasks'], lambda: get_config(ctx, configpath,
+                branch=branch)),
+        ('virtualenv', ['config'], lambda: activate_virtualenv(ctx,
+                projectname)),
+        ('requirements', ['virtualenv'], lambda: install_requirements(ctx,
+                upgrade=upgradereqs)),
+        ('clone', ['config'], lambda: clone(ctx, 'config/base.cfg')),
+        # fetch also runs pip so it must not overlap with requirements
+        ('fetch', ['clone', 'requirements'], lambda: fetch(ctx)),
+        # fetch updates tryton/sao and pops and pushes the patches, so SAO
+        # is installed and built once its sources are final
+        ('sao_install', ['fetch'], lambda: sao_install(ctx)),
+        ('sao_grunt', ['sao_install', 'fetch'], lambda: sao_grunt(ctx)),
+        ]
+    if lockfile:
+        stages[3:6] = [
+            ('requirements', ['virtualenv'],
+                lambda: install_locked_requirements(requirements_lockfile)),
+            ('clone', ['config'], lambda: clone(ctx, lockfile)),
+            ('fetch', ['clone'], lambda: pull(ctx, config=lockfile,
+                    ignore_missing=True, check_remote=False)),
+            ]
+    # clone and fetch start process pools from the stage threads while other
+    # stages write to the terminal. Forking this threaded process could copy
+    # a lock held by another thread into the workers and hang them, so they
+    # are forked from a single threaded server instead.
+    multiprocessing.set_start_method('forkserver', force=True)
+    times = run_stages(stages)
+    print_critical_path(stages, times)
 
     if Path.getcwd() != INITIAL_PATH:
         os.chdir(INITIAL_PATH)
 
 
 __all__ = ['get_tasks', 'get_config', 'activate_virtualenv',
-    'install_requirements', 'install_proteus', 'bootstrap']
+    'install_requirements', 'install_proteus', 'bootstrap', 'lock']
 
 BootstrapCollection = Collection()
 BootstrapCollection.add_task(bootstrap)
@@ -212,3 +383,4 @@ BootstrapCollection.add_task(get_tasks)
 BootstrapCollection.add_task(activate_virtualenv)
 BootstrapCollection.add_task(install_requirements)
 BootstrapCollection.add_task(install_proteus)
+BootstrapCollection.add_task(lock)
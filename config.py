@@ -1,13 +1,15 @@
+import io
 import os
 import configparser
 from invoke import Collection, task, run
-from .scm import get_repo, hg_status, git_status
+from .scm import get_repo, hg_status, git_status, run_repos
 from collections import OrderedDict
-import hgapi
-from pick import pick
 from path import Path
 from .utils import (t, get_config_files, read_config_file, remove_dir,
-    NO_MODULE_REPOS)
+    NO_MODULE_REPOS, lazy_import)
+from .hgserver import hg
+
+pick = lazy_import('pick')
 
 
 def get_config():
@@ -24,27 +26,46 @@ def get_config():
     return settings
 
 
+def _revision(repo):
+    return repo['function'](repo['name'], repo['path'], verbose=False)
+
+
 @task()
 def set_revision(ctx, config=None):
-    """ Set branch on repository config files """
+    """ Set the current revision on repository config files """
 
     if config is None:
         config_files = get_config_files()
     else:
         config_files = [config]
 
+    configs = []
+    repos = []
+    sections = []
     for config_file in config_files:
         Config = read_config_file(config_file, type='all', unstable=True)
-        f_d = open(config_file, 'w+')
+        configs.append((config_file, Config))
         for section in Config.sections():
             if Config.has_option(section, 'patch'):
                 continue
-            repo = get_repo(section, Config, 'revision')
-            revision = repo['function'](section, repo['path'], verbose=False)
+            repos.append(get_repo(section, Config, 'revision'))
+            sections.append((Config, section))
+
+    # Resolve the revisions of all the files at once
+    for (Config, section), (revision, _) in zip(sections,
+            run_repos(_revision, repos)):
+        if revision:
             Config.set(section, 'revision', revision)
 
+    for config_file, Config in configs:
+        f_d = io.StringIO()
         Config.write(f_d)
-        f_d.close()
+        content = f_d.getvalue()
+        with open(config_file) as f:
+            if f.read() == content:
+                continue
+        with open(config_file, 'w') as f:
+            f.write(content)
 
 
 @task()
@@ -83,8 +104,7 @@ def add_modules(ctx, config, version, owner, modules="./modules"):
         # if v != version:
         #     continue
 
-        repo = hgapi.Repo(path)
-        url = repo.config('paths', 'default')
+        url = hg(path, 'config', 'paths.default', check=False)[1].strip()
 
         if owner and "/%s/" % owner not in url:
             continue
@@ -157,7 +177,7 @@ def unknown(ctx, unstable=True, status=False, show=True, remove=False, quiet=Fal
         config_files = get_config_files()
         for repo in modules_wo_repo + repo_not_in_cfg:
             title = 'Add "%s" to Config Fille:' % repo
-            option, index = pick(config_files, title, default_index=1)
+            option, index = pick.pick(config_files, title, default_index=1)
             path = os.path.join('./modules', repo)
             add_module(option, path)
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Client of the Mercurial command server (hg serve --cmdserver pipe).
+
+Each repository gets one persistent hg process per worker process, so
+running several commands on it does not pay for hg start up every time.
+"""
+import atexit
+import os
+import struct
+import subprocess
+from collections import OrderedDict
+
+# Maximum number of servers kept open by each process
+MAX_SERVERS = 8
+
+
+class HgError(Exception):
+    def __init__(self, args, exit_code, stdout='', stderr=''):
+        super().__init__('hg %s: %s' % (' '.join(args), stderr.strip()))
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class HgServer(object):
+    def __init__(self, path):
+        self.path = path
+        env = dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+        # Never start an external merge tool, conflicts are left with markers
+        self.process = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe',
+                '--config', 'ui.interactive=False',
+                '--config', 'ui.merge=internal:merge'], cwd=path, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # The server starts sending its capabilities
+        channel, hello = self.read_channel()
+        if channel != b'o' or b'runcommand' not in hello:
+            self.close()
+            raise HgError(['serve'], -1, stderr='Invalid command server '
+                'hello in %s' % path)
+
+    def read_channel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            raise HgError(['serve'], -1, stderr='Command server of %s died'
+                % self.path)
+        channel, length = struct.unpack('>cI', header)
+        if channel in (b'I', b'L'):
+            # Input requests have the maximum size instead of data
+            return channel, length
+        return channel, self.process.stdout.read(length)
+
+    def run(self, *args, output=None):
+        """
+        Run the hg command args and return its exit code, output and error.
+        If output is given it is called with each chunk of output instead of
+        collecting it.
+        """
+        data = '\0'.join(args).encode('utf-8')
+        self.process.stdin.write(b'runcommand\n' + struct.pack('>I', len(data))
+            + data)
+        self.process.stdin.flush()
+        stdout, stderr = [], []
+        while True:
+            channel, data = self.read_channel()
+            if channel == b'o':
+                if output:
+                    output(data)
+                else:
+                    stdout.append(data)
+            elif channel == b'e':
+                stderr.append(data)
+            elif channel == b'r':
+                exit_code, = struct.unpack('>i', data)
+                break
+            elif channel in (b'I', b'L'):
+                # Non interactive: answer with an empty input
+                self.process.stdin.write(struct.pack('>I', 0))
+                self.process.stdin.flush()
+            elif channel.isupper():
+                raise HgError(args, -1, stderr='Unexpected channel %r'
+                    % channel)
+        return (exit_code, b''.join(stdout).decode('utf-8', 'replace'),
+            b''.join(stderr).decode('utf-8', 'replace'))
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+_servers = OrderedDict()
+
+
+def get_server(path):
+    """
+    Return the command server of the repository in path for the current
+    process. Servers inherited from the parent process are not reused.
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    server = _servers.pop(key, None)
+    if server is None or server.process.poll() is not None:
+        server = HgServer(path)
+    _servers[key] = server
+    while len(_servers) > MAX_SERVERS:
+        (pid, _), oldest = _servers.popitem(last=False)
+        if pid == os.getpid():
+            oldest.close()
+    return server
+
+
+def hg(path, *args, **kwargs):
+    """
+    Run the hg command args in the repository of path and return its
+    output. Raises HgError if it fails.
+
+    Use check=False to get the (exit code, output, error) tuple instead.
+    """
+    check = kwargs.pop('check', True)
+    exit_code, stdout, stderr = get_server(path).run(*args, **kwargs)
+    if not check:
+        return exit_code, stdout, stderr
+    if exit_code:
+        raise HgError(args, exit_code, stdout, stderr)
+    return stdout
+
+
+@atexit.register
+def close_servers():
+    pid = os.getpid()
+    for (server_pid, _), server in list(_servers.items()):
+        if server_pid == pid:
+            server.close()
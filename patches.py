@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 from invoke import task, Collection, run
-from .utils import t
+from .utils import t, get_cache_dir
+import hashlib
 import os
-
-from quilt.push import Push
-from quilt.pop import Pop
-from quilt.error import AllPatchesApplied, QuiltError, UnknownPatch
+import re
+import shutil
+import subprocess
+import tempfile
+from multiprocessing import Pool
 
 patches_dir = "patches"
 pc_dir = ".pc"
@@ -33,10 +35,107 @@ def unapplied(ctx,):
         print(t.red(patch))
 
 
-def _pop(force=False):
+def read_series():
+    """
+    Return the name, strip level and reverse flag of the patches in the
+    series, with the options parsed by quilt.
+    """
+    from quilt.db import Series
+
+    series = Series(patches_dir)
+    if not series.exists():
+        return []
+    return [(x.get_name(), int(x.strip), x.reverse)
+        for x in series.patches()]
+
+
+def read_applied():
+    """ Return the names of the applied patches, from bottom to top """
+    path = os.path.join(pc_dir, 'applied-patches')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [x.strip() for x in f if x.strip()]
+
+
+HUNK_HEADER = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+
+def patch_files(name, strip=1):
+    """ Return the paths, from the root, of the files changed by patch """
+    files = set()
+    # Lines left in the current hunk: removed or added lines inside it may
+    # start with '--- ' or '+++ ' too
+    old = new = 0
+    with open(os.path.join(patches_dir, name), errors='replace') as f:
+        for line in f:
+            if old > 0 or new > 0:
+                if line.startswith(' ') or line in ('\n', '\r\n'):
+                    old -= 1
+                    new -= 1
+                elif line.startswith('-'):
+                    old -= 1
+                elif line.startswith('+'):
+                    new -= 1
+                continue
+            match = HUNK_HEADER.match(line)
+            if match:
+                old, new = (int(x) if x is not None else 1
+                    for x in match.groups())
+                continue
+            if not line.startswith(('--- ', '+++ ')):
+                continue
+            filename = line[4:].rstrip('\n').split('\t')[0].strip()
+            if filename == '/dev/null':
+                continue
+            files.add('/'.join(filename.split('/')[strip:]))
+    return files
+
+
+def patches_touching(repos, names=None):
+    """
+    Return the names of the patches of the series (or of names) that change
+    files of the repository paths of repos.
+    """
+    repos = [os.path.normpath(x) + '/' for x in repos]
+    touching = []
+    for name, strip, _ in read_series():
+        if names is not None and name not in names:
+            continue
+        for filename in patch_files(name, strip):
+            if any(filename.startswith(x) for x in repos):
+                touching.append(name)
+                break
+    return touching
+
+
+def _pop(force=False, repos=None):
+    """
+    Unapply the patches. If repos is set, only the ones above and including
+    the first applied patch that changes files of those repository paths.
+    """
+    from quilt.pop import Pop
+    from quilt.error import QuiltError, UnknownPatch
+
     pop = Pop(os.getcwd(), pc_dir)
     try:
-        pop.unapply_all(force)
+        if repos is None:
+            pop.unapply_all(force)
+        else:
+            applied = read_applied()
+            touching = patches_touching(repos, applied)
+            if not touching:
+                print(t.green('OK: No applied patches change these '
+                        'repositories'))
+                return 0
+            # The stack is linear: the patches above are unapplied too
+            index = applied.index(touching[0])
+            if index:
+                pop.unapply_patch(applied[index - 1], force)
+            else:
+                pop.unapply_all(force)
+            print(t.green('OK: %d Patches removed' % (len(applied) - index)))
+            return 0
     except QuiltError as e:
         print(t.red('KO: Error applying patch:' + str(e)))
         return -1
@@ -52,10 +151,114 @@ def pop(ctx, force=False):
     _pop(force)
 
 
+def _read(filename):
+    # Quilt handles empty and missing files the same way
+    if not os.path.isfile(filename):
+        return b''
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _result_keys(name, reverse, files, originals):
+    """
+    Return the cache key of the result of applying patch name to each file
+    with the original contents of originals.
+    """
+    with open(os.path.join(patches_dir, name), 'rb') as f:
+        patch_hash = hashlib.sha1(f.read() + (b'R' if reverse else b'')
+            ).hexdigest()
+    keys = {}
+    for filename in files:
+        digest = hashlib.sha1(patch_hash.encode('utf-8'))
+        digest.update(filename.encode('utf-8') + b'\0')
+        digest.update(originals[filename])
+        keys[filename] = digest.hexdigest()
+    return keys
+
+
+def _restore_patch(name, strip, reverse):
+    """
+    Apply patch name with the results cached for the current contents of
+    its files, keeping the quilt backups. Returns False if some result is
+    not cached.
+    """
+    from quilt.db import Db
+    from quilt.patch import Patch
+
+    files = patch_files(name, strip)
+    originals = dict((x, _read(x)) for x in files)
+    keys = _result_keys(name, reverse, files, originals)
+    cache_dir = get_cache_dir('patches')
+    results = {}
+    for filename, key in keys.items():
+        result = os.path.join(cache_dir, key)
+        if os.path.exists(result):
+            results[filename] = result
+        elif os.path.exists(result + '-removed'):
+            results[filename] = None
+        else:
+            return False
+
+    backup_dir = os.path.join(pc_dir, name)
+    for filename, result in results.items():
+        backup = os.path.join(backup_dir, filename)
+        os.makedirs(os.path.dirname(backup), exist_ok=True)
+        with open(backup, 'wb') as f:
+            f.write(originals[filename])
+        if result is None:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            continue
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        shutil.copyfile(result, filename)
+    os.makedirs(backup_dir, exist_ok=True)
+    open(os.path.join(backup_dir, '.timestamp'), 'w').close()
+
+    db = Db(pc_dir)
+    db.add_patch(Patch(name))
+    db.save()
+    return True
+
+
+def _store_patch(name, strip, reverse):
+    """ Cache the results of the applied patch name from its backups """
+    files = patch_files(name, strip)
+    backup_dir = os.path.join(pc_dir, name)
+    originals = dict((x, _read(os.path.join(backup_dir, x))) for x in files)
+    keys = _result_keys(name, reverse, files, originals)
+    cache_dir = get_cache_dir('patches')
+    for filename, key in keys.items():
+        result = os.path.join(cache_dir, key)
+        if os.path.exists(filename):
+            shutil.copyfile(filename, result + '.tmp')
+            os.rename(result + '.tmp', result)
+        else:
+            open(result + '-removed', 'w').close()
+
+
 def _push(force=False, quiet=True):
+    """
+    Apply the unapplied patches of the series. The files of a patch are
+    restored from the cache when it was already applied to the same
+    contents, otherwise it is applied with quilt and its results cached.
+    """
+    from quilt.push import Push
+    from quilt.error import AllPatchesApplied, QuiltError, UnknownPatch
+
     push = Push(os.getcwd(), pc_dir, patches_dir)
     try:
-        push.apply_all(force, quiet)
+        push._check()
+        applied = read_applied()
+        pending = [x for x in read_series() if x[0] not in applied]
+        if not pending:
+            raise AllPatchesApplied(push.series, push.db.top_patch())
+        for name, strip, reverse in pending:
+            if _restore_patch(name, strip, reverse):
+                continue
+            push = Push(os.getcwd(), pc_dir, patches_dir)
+            push.apply_patch(name, force, quiet)
+            _store_patch(name, strip, reverse)
     except AllPatchesApplied:
         print(t.green('OK: Patches already Applied'))
         return 0
@@ -73,8 +276,107 @@ def _push(force=False, quiet=True):
 def push(ctx, force=False, quiet=True):
     _push(force=False, quiet=True)
 
+
+def _check_chain(chain):
+    """
+    Apply in order the patches of chain, a list of (name, strip, reverse,
+    files), on
+    a temporary copy of the unpatched files they change. Returns the name,
+    output and rejected hunks of the patches that do not apply.
+    """
+    base = {}
+    applied = read_applied()
+    for name, strip, reverse, files in chain:
+        for filename in files:
+            if filename in base:
+                continue
+            base[filename] = filename
+            # Applied patches changed the file: use the quilt backup
+            for applied_name in applied:
+                backup = os.path.join(pc_dir, applied_name, filename)
+                if os.path.exists(backup):
+                    base[filename] = backup
+                    break
+
+    failed = []
+    with tempfile.TemporaryDirectory(prefix='tasks-patches-') as tmp:
+        for filename, source in base.items():
+            if os.path.isfile(source) and os.path.getsize(source):
+                target = os.path.join(tmp, filename)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+        for name, strip, reverse, files in chain:
+            reject = os.path.join(tmp, '.reject')
+            result = subprocess.run(['patch', '-p%d' % strip, '--batch',
+                    '--forward', '--no-backup-if-mismatch',
+                    '--reject-file', reject, '-d', tmp,
+                    '-i', os.path.abspath(os.path.join(patches_dir, name))]
+                + (['-R'] if reverse else []),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True)
+            if not result.returncode:
+                continue
+            hunks = ''
+            if os.path.exists(reject):
+                with open(reject, errors='replace') as f:
+                    hunks = f.read()
+                os.unlink(reject)
+            failed.append((name, result.stdout, hunks))
+    return failed
+
+
+def patch_chains():
+    """
+    Group the patches of the series that change the same files. Each chain
+    keeps the series order and is independent of the others.
+    """
+    chains = []
+    series = read_series()
+    for name, strip, reverse in series:
+        files = patch_files(name, strip)
+        chain = [(name, strip, reverse, files)]
+        for other in chains[:]:
+            if any(files & x[3] for x in other):
+                chains.remove(other)
+                chain = other + chain
+        chains.append(chain)
+    # Joined chains must stay in series order
+    order = dict((x[0], i) for i, x in enumerate(series))
+    return [sorted(x, key=lambda x: order[x[0]]) for x in chains]
+
+
+@task()
+def check(ctx):
+    """
+    Check that all the patches of the series apply to the unpatched files
+    without changing them.
+    """
+    chains = patch_chains()
+    p = Pool()
+    try:
+        failed = sum(p.map(_check_chain, chains), [])
+    finally:
+        p.close()
+    order = [x[0] for x in read_series()]
+    failed.sort(key=lambda x: order.index(x[0]))
+    patches = sum(len(x) for x in chains)
+    if not failed:
+        print(t.green('OK: All %d Patches apply' % patches))
+        return 0
+    for name, output, hunks in failed:
+        print(t.bold_red('[' + name + ']'))
+        print(output.rstrip())
+        if hunks:
+            print(t.bold('Rejected hunks:'))
+            print(hunks.rstrip())
+        print('')
+    print(t.red('KO: %d of %d Patches do not apply' % (len(failed),
+                patches)))
+    return -1
+
 QuiltCollection = Collection()
 QuiltCollection.add_task(pop)
 QuiltCollection.add_task(applied)
 QuiltCollection.add_task(unapplied)
 QuiltCollection.add_task(push)
+QuiltCollection.add_task(check)
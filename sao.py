@@ -1,34 +1,165 @@
 #!/usr/bin/env python
+import gzip
+import hashlib
 import os
+import shutil
+import subprocess
 from invoke import task, Collection
-from blessings import Terminal
+from .utils import t, get_cache_dir, hash_files
 
 SAO_DIR = './tryton/sao'
+DEPENDENCIES = ['node_modules', 'bower_components']
+INSTALL_STAMP = '.install-stamp'
+GRUNT_STAMP = '.grunt-stamp'
+GRUNT_EXCLUDE = DEPENDENCIES + ['dist', '.git', '.hg']
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_EXTENSIONS = ('.js', '.css', '.html', '.json', '.svg', '.map')
+
+
+def _read_stamp(name):
+    path = os.path.join(SAO_DIR, name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _write_stamp(name, value):
+    with open(os.path.join(SAO_DIR, name), 'w') as f:
+        f.write(value)
+
+
+def _copy_dependencies(src, dst):
+    # Files are copied, not hard linked: npm, bower and postinstall scripts
+    # write in place and would change the cached snapshot too
+    for name in DEPENDENCIES:
+        target = os.path.join(dst, name)
+        if os.path.lexists(target):
+            shutil.rmtree(target)
+        shutil.copytree(os.path.join(src, name), target, symlinks=True)
 
-t = Terminal()
 
 @task
 def install(ctx):
-    'Install SAO'
-    os.chdir(SAO_DIR)
-    os.system('npm install')
-    os.system('bower install')
+    '''
+    Install SAO
 
-    # download TinyMCE
-    os.system('bower install tinymce#4.9.3')
-    os.system('bower install tinymce-i18n')
-    os.system('ln -s ../tinymce-i18n/langs bower_components/tinymce/langs')
+    Dependencies are cached by the hash of package.json and bower.json, so
+    they are only installed when those files change.
+    '''
+    key = hash_files([os.path.join(SAO_DIR, 'package.json'),
+            os.path.join(SAO_DIR, 'bower.json')])
+    if (_read_stamp(INSTALL_STAMP) == key and all(os.path.isdir(
+                    os.path.join(SAO_DIR, x)) for x in DEPENDENCIES)):
+        print(t.bold('SAO dependencies up to date'))
+        return
+
+    cache = get_cache_dir('sao', key)
+    if all(os.path.isdir(os.path.join(cache, x)) for x in DEPENDENCIES):
+        print('Restoring SAO dependencies from cache')
+        _copy_dependencies(cache, SAO_DIR)
+    else:
+        # npm and bower install into different directories so they can run
+        # at the same time. TinyMCE and its translations are downloaded in a
+        # single bower call.
+        processes = [
+            subprocess.Popen('npm install', shell=True, cwd=SAO_DIR),
+            subprocess.Popen(' && '.join([
+                        'bower install',
+                        'bower install tinymce#4.9.3 tinymce-i18n',
+                        'ln -sfn ../tinymce-i18n/langs '
+                        'bower_components/tinymce/langs',
+                        ]), shell=True, cwd=SAO_DIR),
+            ]
+        if any([p.wait() for p in processes]):
+            print(t.bold_red('SAO dependencies install failed'))
+            return
+        tmp = cache + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        _copy_dependencies(SAO_DIR, tmp)
+        shutil.rmtree(cache)
+        os.rename(tmp, cache)
+    _write_stamp(INSTALL_STAMP, key)
 
     print(t.bold('Done'))
 
+
+def _sources_hash():
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(SAO_DIR):
+        dirs[:] = sorted(x for x in dirs if x not in GRUNT_EXCLUDE)
+        for name in sorted(files):
+            # Stamps and the files written by compress are not sources
+            if (name in (INSTALL_STAMP, GRUNT_STAMP)
+                    or name.endswith(('.gz', '.br'))):
+                continue
+            stat = os.stat(os.path.join(root, name))
+            digest.update(('%s %s %s\n' % (os.path.join(root, name),
+                        stat.st_mtime, stat.st_size)).encode('utf-8'))
+    return digest.hexdigest()
+
+
 @task
-def grunt(ctx):
-    'Grunt SAO'
-    os.chdir(SAO_DIR)
-    os.system('grunt dev')
+def grunt(ctx, force=False):
+    '''
+    Grunt SAO
+
+    The build is skipped if no source changed since the last one.
+    '''
+    if (not force and _read_stamp(GRUNT_STAMP) == _sources_hash()
+            and os.path.isdir(os.path.join(SAO_DIR, 'dist'))):
+        print(t.bold('SAO build up to date'))
+        return
+    if subprocess.call('grunt dev', shell=True, cwd=SAO_DIR):
+        print(t.bold_red('SAO build failed'))
+        return
+    # Hashed after the build as it writes outputs in the source tree too
+    # (e.g. the locale JSON files)
+    _write_stamp(GRUNT_STAMP, _sources_hash())
 
     print(t.bold('Done'))
 
+
+@task
+def compress(ctx, path=SAO_DIR):
+    '''
+    Write gzip (and brotli if installed) versions of SAO static files,
+    served by the StaticFiles middleware of wsgi.py
+    '''
+    count = 0
+    for root, dirs, files in os.walk(path):
+        if 'node_modules' in dirs:
+            dirs.remove('node_modules')
+        for name in files:
+            if not name.endswith(COMPRESS_EXTENSIONS):
+                continue
+            filename = os.path.join(root, name)
+            mtime = os.path.getmtime(filename)
+            with open(filename, 'rb') as f:
+                content = f.read()
+            compressors = [('.gz', lambda x: gzip.compress(x, 9))]
+            if brotli:
+                compressors.append(('.br', brotli.compress))
+            for suffix, compressor in compressors:
+                target = filename + suffix
+                if (os.path.exists(target)
+                        and os.path.getmtime(target) >= mtime):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressor(content))
+                count += 1
+
+    print(t.bold('%d files compressed' % count))
+
 SaoCollection = Collection()
 SaoCollection.add_task(install)
 SaoCollection.add_task(grunt)
+SaoCollection.add_task(compress)
@@ -1,19 +1,26 @@
 #!/usr/bin/env python
+import contextlib
+import json
 import subprocess
+import tempfile
+import traceback
 from invoke import Collection, task, run
-import hgapi
-import git
 import os
+import re
 import sys
 import time
-from blessings import Terminal
 from multiprocessing import Process
 from multiprocessing import Pool
 import shutil
 import configparser
+import hashlib
 from . import patches
-from .utils import t, read_config_file, execBashCommand
+from .utils import (t, read_config_file, timing, print_timings,
+    install_requirements_offline, lazy_import, get_cache_dir)
 from .runner import execute
+from .hgserver import hg, HgError
+
+git = lazy_import('git')
 
 MAX_PROCESSES = 25
 
@@ -73,8 +80,174 @@ def wait_processes(processes, maximum=MAX_PROCESSES, exit_code=None):
             del processes[i]
 
 
-def check_revision(client, module, revision, branch):
-    if client.revision(revision).branch != branch:
+def _timed(args):
+    func, repo = args
+    start = time.time()
+    res = func(repo)
+    return res, time.time() - start
+
+
+def run_repos(func, repos, processes=MAX_PROCESSES):
+    """
+    Call func with each repo on a pool of processes.
+
+    Returns a list of (result, elapsed seconds) in the same order as repos.
+    """
+    p = Pool(processes)
+    try:
+        return p.map(_timed, [(func, repo) for repo in repos])
+    finally:
+        p.close()
+
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+
+def _captured(args):
+    func, repo = args
+    # Output goes to files so large diffs are not kept in memory
+    stdout = tempfile.NamedTemporaryFile('w', prefix='tasks-', delete=False)
+    stderr = tempfile.NamedTemporaryFile('w', prefix='tasks-', delete=False)
+    start = time.time()
+    with stdout, stderr, contextlib.redirect_stdout(stdout), \
+            contextlib.redirect_stderr(stderr):
+        try:
+            result = func(repo)
+        except Exception:
+            traceback.print_exc()
+            result = -1
+    return {
+        'repo': repo['name'],
+        'result': result,
+        'output': stdout.name,
+        'errors': stderr.name,
+        'time': time.time() - start,
+        }
+
+
+def _copy_output(filename, output, json_output=False):
+    with open(filename) as f:
+        if json_output:
+            content = ANSI_ESCAPE.sub('', f.read())
+        else:
+            shutil.copyfileobj(f, output)
+            content = None
+    os.unlink(filename)
+    return content
+
+
+def write_results(results, json_output=False, stream=False):
+    """
+    Write the output of the repositories in order. Unless stream is set it
+    is written when all of them finished.
+
+    Returns the list of results.
+    """
+    written = []
+    for result in results:
+        output = _copy_output(result.pop('output'), sys.stdout, json_output)
+        errors = _copy_output(result.pop('errors'), sys.stderr, json_output)
+        written.append(result)
+        if json_output:
+            entry = dict(result, output=output, errors=errors)
+            sys.stdout.write(json.dumps(entry, default=str) + '\n')
+        if stream:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    sys.stdout.flush()
+    return written
+
+
+def run_repos_output(func, repos, json_output=False, stream=False,
+        processes=MAX_PROCESSES):
+    """
+    Call func with each repo on a pool of processes capturing what it
+    writes, and write it in the order of repos.
+
+    Returns a list of dicts with the repo name, the result of func and the
+    time it took.
+    """
+    p = Pool(processes)
+    try:
+        args = [(func, repo) for repo in repos]
+        if stream:
+            results = p.imap(_captured, args)
+        else:
+            results = p.map(_captured, args)
+        return write_results(results, json_output, stream)
+    finally:
+        p.close()
+
+
+def messages(json_output=False):
+    "Send the messages of a task to stderr if stdout is used for JSON"
+    if json_output:
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
+
+
+# Metadata of the hg repositories already read by this process
+_hg_metadata = {}
+
+
+class HgMetadata(dict):
+    """
+    Current branch ('branch'), heads by branch ('heads'), branch by head
+    ('branches') and default path ('default') of an hg repository. Each one
+    is read when it is first used.
+    """
+
+    def __init__(self, path):
+        super(HgMetadata, self).__init__()
+        self.path = path
+
+    def __missing__(self, key):
+        if key in ('heads', 'branches'):
+            heads = {}
+            branches = {}
+            for line in hg(self.path, 'heads', '-T',
+                    '{branch}\t{node|short}\n').splitlines():
+                branch, node = line.split('\t')
+                # Heads are sorted from the newest
+                heads.setdefault(branch, node)
+                branches[node] = branch
+            self['heads'] = heads
+            self['branches'] = branches
+        elif key == 'branch':
+            self[key] = hg(self.path, 'branch').strip()
+        elif key == 'default':
+            self[key] = hg(self.path, 'config', 'paths.default',
+                check=False)[1].strip()
+        else:
+            raise KeyError(key)
+        return self[key]
+
+
+def hg_metadata(path):
+    """
+    Return the HgMetadata of the hg repository in path, shared by the whole
+    process.
+    """
+    key = os.path.abspath(path)
+    if key not in _hg_metadata:
+        _hg_metadata[key] = HgMetadata(path)
+    return _hg_metadata[key]
+
+
+def hg_metadata_changed(path):
+    "Forget the metadata of path after a command that changes it"
+    _hg_metadata.pop(os.path.abspath(path), None)
+
+
+def hg_revision_branch(path, revision):
+    branch = hg_metadata(path)['branches'].get(revision)
+    if branch is None:
+        branch = hg(path, 'log', '-r', revision, '-T', '{branch}')
+    return branch
+
+
+def check_revision(path, module, revision, branch):
+    if hg_revision_branch(path, revision) != branch:
         print(t.bold_red('[' + module + ']'))
         print(("Invalid revision '%s': it isn't in branch '%s'"
             % (revision, branch)))
@@ -90,6 +263,13 @@ def git_clone(url, path, branch="main", revision="main"):
             print('Cloning %s...' % path)
             execute('git clone -v -b %s %s %s' % (branch, url, path), timeout=600,
                 log=True)
+            if revision and revision != branch:
+                result = run('cd %s; git checkout -q %s' % (path, revision),
+                    warn=True, hide='both')
+                if not result.ok:
+                    print(t.red("= " + path + " = KO!"), file=sys.stderr)
+                    print(result.stderr, file=sys.stderr)
+                    return -1
             break
         except subprocess.TimeoutExpired as e:
             print('Clone of %s failed with %s (%s retries left)' % (path, repr(e), str(retries)))
@@ -113,12 +293,16 @@ def hg_clone(url, path, branch="default", revision=None):
     while retries:
         retries -= 1
         try:
-            client = hgapi.hg_clone(url, path, *extended_args)
-            res = check_revision(client, path, revision, branch)
+            result = run('hg clone %s %s %s' % (' '.join(extended_args), url,
+                    path), warn=True, hide='both')
+            if not result.ok:
+                raise HgError(['clone', url, path], result.exited,
+                    result.stdout, result.stderr)
+            res = check_revision(path, path, revision, branch)
             print("Repo " + t.bold(path) + t.green(" Updated") + \
                 " to Revision: " + revision)
             return res
-        except hgapi.HgException as e:
+        except HgError as e:
             if retries:
                 print(t.bold_yellow('[' + path + '] (%d)' % retries))
             else:
@@ -141,7 +325,6 @@ def clone(ctx, config=None, unstable=True, development=False):
     # Updates config repo to get new repos in config files
     git_pull('config', 'config', True)
 
-    remove_symlinks()
     Config = read_config_file(config, unstable=unstable)
     p = Pool(MAX_PROCESSES)
     repos = []
@@ -154,43 +337,71 @@ def clone(ctx, config=None, unstable=True, development=False):
     exit_code = sum(exit_codes, 0)
     if exit_code < 0:
         print(t.bold_red('Clone Task finished with errors!'))
-    create_symlinks()
+    reconcile_symlinks()
     return 0
 
-def remove_symlinks():
-    """
-    Remove all symlinks found in tryton/trytond/trytond/modules
-    """
-    modules_path = 'tryton/trytond/trytond/modules'
-    if not os.path.exists(modules_path):
-        return
-    for module in os.listdir(modules_path):
-        if os.path.islink(os.path.join(modules_path, module)):
-            os.remove(os.path.join(modules_path, module))
+MODULES_PATH = 'tryton/trytond/trytond/modules'
 
-def create_symlinks():
-    """
-    Create a symbolic in tryton/trytond/trytond/modules for each file in
-    tryton/modules
-    """
-    modules_path = 'tryton/trytond/trytond/modules'
-    for module in os.listdir('tryton/modules'):
-        module_path = os.path.join(modules_path, module)
-        if os.path.exists(module_path):
-            continue
-        os.symlink('../../../modules/' + module, module_path)
+ROOT_SYMLINKS = [
+    ('sao', 'tryton/sao'),
+    ('trytond', 'tryton/trytond'),
+    ('proteus', 'tryton/proteus'),
+    ('modules', MODULES_PATH),
+    ]
 
-    if not os.path.exists('sao'):
-        os.symlink('tryton/sao', 'sao')
 
-    if not os.path.exists('trytond'):
-        os.symlink('tryton/trytond', 'trytond')
+def reconcile_symlinks(dry_run=False):
+    """
+    Make the symlinks in tryton/trytond/trytond/modules match the modules
+    found in tryton/modules, only adding and removing the links that differ
+    so unchanged modules are not touched.
+
+    Returns the lists of added and removed links.
+    """
+    desired = {}
+    if os.path.isdir('tryton/modules') and os.path.isdir(MODULES_PATH):
+        for module in os.listdir('tryton/modules'):
+            desired[os.path.join(MODULES_PATH, module)] = (
+                '../../../modules/' + module)
+
+    existing = {}
+    if os.path.isdir(MODULES_PATH):
+        for module in os.listdir(MODULES_PATH):
+            link = os.path.join(MODULES_PATH, module)
+            if os.path.islink(link):
+                existing[link] = os.readlink(link)
+
+    removed = sorted(link for link, target in existing.items()
+        if desired.get(link) != target)
+    added = sorted(link for link, target in desired.items()
+        if existing.get(link) != target
+        and (link in existing or not os.path.exists(link)))
+    # Root links are only created when missing
+    for link, target in ROOT_SYMLINKS:
+        if not os.path.lexists(link):
+            desired[link] = target
+            added.append(link)
+
+    if not dry_run:
+        for link in removed:
+            os.remove(link)
+        for link in added:
+            os.symlink(desired[link], link)
+    return added, removed
 
-    if not os.path.exists('proteus'):
-        os.symlink('tryton/proteus', 'proteus')
 
-    if not os.path.exists('modules'):
-        os.symlink('tryton/trytond/trytond/modules', 'modules')
+@task()
+def symlinks(ctx, dry_run=False):
+    """
+    Add and remove the module symlinks in tryton/trytond/trytond/modules
+    """
+    added, removed = reconcile_symlinks(dry_run)
+    for link in removed:
+        print(t.red('- ' + link))
+    for link in added:
+        print(t.green('+ ' + link))
+    if not added and not removed:
+        print('Symlinks up to date')
 
 
 def print_status(module, files):
@@ -250,9 +461,10 @@ def git_status(module, path, url=None, verbose=False):
 
 
 def hg_status(module, path, url=None, verbose=False):
-    repo = hgapi.Repo(path)
     hg_check_url(module, path, url)
-    st = repo.hg_status(empty=True)
+    st = {}
+    for line in hg(path, 'status').splitlines():
+        st.setdefault(line[0], []).append(line[2:])
     print_status(module, st)
     return st
 
@@ -262,11 +474,15 @@ def _status(repo):
         repo['verbose'])
 
 
-@task()
-def status(ctx, config=None, unstable=True, no_quilt=False, verbose=False):
+@task(help={
+        'json': 'write one JSON object per repository',
+        'stream': 'write each repository as soon as it is finished',
+        })
+def status(ctx, config=None, unstable=True, no_quilt=False, verbose=False,
+        json_=False, stream=False):
     if not no_quilt:
-        patches._pop()
-    p = Pool(MAX_PROCESSES)
+        with messages(json_):
+            patches._pop()
     Config = read_config_file(config, unstable=unstable)
     repos = []
     for section in Config.sections():
@@ -277,41 +493,115 @@ def status(ctx, config=None, unstable=True, no_quilt=False, verbose=False):
             continue
         repos.append(repo)
         repo['verbose'] = verbose
-    p.map(_status, repos)
+    run_repos_output(_status, repos, json_, stream)
     if not no_quilt:
-        patches._push()
+        with messages(json_):
+            patches._push()
+
+
+# Hash of the empty tree, the base of the base diffs
+GIT_EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+
+def _split_git_diff(diff):
+    "Return the diff of each file of a diff in git format"
+    files = {}
+    name = None
+    for line in diff.splitlines(True):
+        if line.startswith('diff --git a/'):
+            # Header is 'a/<name> b/<name>' as the base is empty
+            header = line[len('diff --git '):].rstrip('\n')
+            name = header[2:2 + (len(header) - 5) // 2]
+            files[name] = []
+        if name is not None:
+            files[name].append(line)
+    return {k: ''.join(v) for k, v in files.items()}
+
+
+def cached_base_diff(path, blobs, compute):
+    """
+    Return the base diff of the files of blobs, a dict of the blob id of
+    each file at the revision. Only the files whose blob is not in the
+    cache are diffed, calling compute with their names. compute returns
+    None if the diff failed: those files are then left out of the result
+    and nothing is cached for them.
+    """
+    cache_dir = get_cache_dir('base-diff')
+    filenames = {}
+    for name, blob in blobs.items():
+        key = hashlib.sha1(('%s\0%s\0%s' % (os.path.abspath(path), name,
+                    blob)).encode('utf-8')).hexdigest()
+        filenames[name] = os.path.join(cache_dir, key)
+    missing = [x for x in sorted(blobs) if not os.path.exists(filenames[x])]
+    diffs = {}
+    if missing:
+        computed = compute(missing)
+        if computed is not None:
+            diffs = _split_git_diff(computed)
+            for name in missing:
+                with open(filenames[name], 'w') as f:
+                    f.write(diffs.get(name, ''))
+    base_diff = []
+    for name in sorted(blobs):
+        if name in missing:
+            base_diff.append(diffs.get(name, ''))
+            continue
+        with open(filenames[name]) as f:
+            base_diff.append(f.read())
+    return ''.join(base_diff)
 
 
 def git_base_diff(path, module):
-    files = " ".join(git_status(module, path))
-    diff = run('cd %s; git diff %s ' % (path, files), hide=True,
-        encoding='utf-8')
-    rev = run('cd %s; git hash-object -t tree /dev/null' % (path),
-        hide=True, warn=True, encoding='utf-8')
-    base_diff = run('cd %s;git diff-tree -p %s %s %s' % (path,
-        rev.stdout.replace('\n', ''), 'HEAD',  files), hide=True, warn=True,
-        encoding='utf-8')
-    return diff.stdout, base_diff.stdout
+    files = git_status(module, path)
+    diff = subprocess.run(['git', 'diff'] + files, cwd=path,
+        stdout=subprocess.PIPE, universal_newlines=True)
+    tree = subprocess.run(['git', 'ls-tree', '-r', '-z', 'HEAD', '--']
+        + files, cwd=path, stdout=subprocess.PIPE, universal_newlines=True)
+    blobs = {}
+    for entry in tree.stdout.split('\0'):
+        if entry:
+            info, name = entry.split('\t', 1)
+            blobs[name] = info.split()[2]
+
+    def compute(names):
+        result = subprocess.run(['git', 'diff-tree', '-p', GIT_EMPTY_TREE,
+                'HEAD', '--'] + names, cwd=path, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode:
+            return None
+        return result.stdout
+
+    return diff.stdout, cached_base_diff(path, blobs, compute)
 
 
 def get_branch(path, repo_type='git'):
     if repo_type == 'hg':
-        branch = run('cd %s; hg branch' % path, hide=True)
-        branch = branch.stdout.split('\n')[0]
+        branch = hg_metadata(path)['branch']
     else:
-        branch = run('cd %s; git branch' % path, hide=True)
-        branch = branch.stdout.split('\n')[0].replace('*','').replace('\r','')
+        branch = git_branch_table(path)[0] or ''
     return branch
 
 
 def hg_base_diff(path, module):
-    files = " ".join(hg_status(module, path))
-    branch = get_branch(path)
-    diff = run('cd %s; hg diff --git %s ' % (path, files), hide=True,
-        encoding='utf-8')
-    base_diff = run('cd %s; hg diff --git -r null:%s  %s' % (path, branch,
-        files), hide=True, warn=True, encoding='utf-8')
-    return diff.stdout, base_diff.stdout
+    files = sum(hg_status(module, path).values(), [])
+    branch = get_branch(path, 'hg')
+    diff = hg(path, 'diff', '--git', *files, check=False)[1]
+    manifest = hg(path, 'manifest', '--debug', '-r', branch, check=False)[1]
+    blobs = {}
+    for line in manifest.splitlines():
+        # '<node> <permissions> <type> <name>'
+        node, name = line[:40], line[47:]
+        if not files or name in files:
+            blobs[name] = node
+
+    def compute(names):
+        exit_code, stdout, _ = hg(path, 'diff', '--git', '-r',
+            'null:%s' % branch, *names, check=False)
+        if exit_code:
+            return None
+        return stdout
+
+    return diff, cached_base_diff(path, blobs, compute)
 
 
 @task()
@@ -328,90 +618,118 @@ def module_diff(ctx, path, module, base=True, show=True, fun=git_base_diff):
     return diff, base_diff
 
 
-def git_diff(module, path, rev1=None, rev2=None):
-    repo = git.Repo(path)
-    diff = repo.git.diff(None)
-    msg = []
-    if diff:
-        d = diff.split('\n')
-        for line in d:
-            if line and line[0] == '-':
-                if module not in ['patches', 'features']:
-                    line = line.replace('--- a','--- a/'+path[2:] )
-                line = t.red + line + t.normal
-            elif line and line[0] == '+':
-                if module not in ['patches', 'features']:
-                    line = line.replace('+++ b','+++ b/'+path[2:] )
-                line = t.green + line + t.normal
-
-            if line:
-                msg.append(line)
-    if msg == []:
-        return
-    msg.insert(0, t.bold('\n[' + module + "]\n"))
-    print("\n".join(msg))
+class DiffWriter(object):
+    """
+    Write the lines of a diff as they are produced, colorized and with the
+    paths rewritten to be relative to the root, after the module header.
+    """
 
+    def __init__(self, module, prefix=None):
+        self.module = module
+        self.prefix = prefix
+        self.started = False
+        self.pending = b''
 
-def hg_diff(module, path, rev1=None, rev2=None):
-    t = Terminal()
-    try:
-        msg = []
-        path_repo = path
-        if not os.path.exists(path_repo):
-            print((t.red("Missing repositori: ")
-                + t.bold(path_repo)), file=sys.stderr)
+    def line(self, line):
+        if not line:
             return
-        repo = hgapi.Repo(path_repo)
+        if not self.started:
+            print(t.bold('\n[' + self.module + "]\n"))
+            self.started = True
+        if line[0] == '-':
+            if self.prefix:
+                line = line.replace('--- a', '--- a/' + self.prefix)
+            line = t.red + line + t.normal
+        elif line[0] == '+':
+            if self.prefix:
+                line = line.replace('+++ b', '+++ b/' + self.prefix)
+            line = t.green + line + t.normal
+        sys.stdout.write(line + '\n')
+
+    def feed(self, data):
+        "Write the complete lines of a chunk of output"
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.line(line.decode('utf-8', 'replace'))
+
+    def close(self):
+        self.feed(b'\n')
+
+
+def diff_prefix(module, path):
+    if module in ['patches', 'features']:
+        return None
+    return os.path.normpath(path)
+
+
+def git_diff(module, path, rev1=None, rev2=None, stat=False):
+    cmd = ['git', 'diff', '--no-color']
+    prefix = diff_prefix(module, path)
+    if prefix:
+        # Let git write the paths relative to the root
+        cmd += ['--src-prefix=a/%s/' % prefix, '--dst-prefix=b/%s/' % prefix]
+    if stat:
+        cmd.append('--stat')
+    cmd += [rev for rev in (rev1, rev2) if rev is not None]
+    writer = DiffWriter(module)
+    process = subprocess.Popen(cmd, cwd=path, stdout=subprocess.PIPE)
+    for line in process.stdout:
+        writer.line(line.decode('utf-8', 'replace').rstrip('\n'))
+    process.wait()
+
+
+def hg_diff(module, path, rev1=None, rev2=None, stat=False):
+    path_repo = path
+    if not os.path.exists(path_repo):
+        print((t.red("Missing repositori: ")
+            + t.bold(path_repo)), file=sys.stderr)
+        return
+    writer = DiffWriter(module, diff_prefix(module, path))
+    try:
         if rev2 is None:
-            rev2 = get_branch(path_repo)
-        msg = []
-        for diff in repo.hg_diff(rev1, rev2):
-            if diff:
-                d = diff['diff'].split('\n')
-                for line in d:
-
-                    if line and line[0] == '-':
-                        if module not in ['patches', 'features']:
-                            line = line.replace('--- a','--- a/'+path[2:] )
-                        line = t.red + line + t.normal
-                    elif line and line[0] == '+':
-                        if module not in ['patches', 'features']:
-                            line = line.replace('+++ b','+++ b/'+path[2:] )
-                        line = t.green + line + t.normal
-
-                    if line:
-                        msg.append(line)
-        if msg == []:
-            return
-        msg.insert(0, t.bold('\n[' + module + "]\n"))
-        print("\n".join(msg))
+            rev2 = get_branch(path_repo, 'hg')
+        cmd = ['diff']
+        for rev in (rev1, rev2):
+            if rev is not None:
+                cmd.extend(['-r', rev])
+        if stat:
+            cmd.append('--stat')
+        hg(path_repo, *cmd, output=writer.feed)
+        writer.close()
     except:
-        msg.insert(0, t.bold('\n[' + module + "]\n"))
-        msg.append(str(sys.exc_info()[1]))
-        print("\n".join(msg), file=sys.stderr)
+        print(t.bold('\n[' + module + "]\n"), file=sys.stderr)
+        print(str(sys.exc_info()[1]), file=sys.stderr)
 
 
 def _diff(repo):
-    return repo['function'](repo['name'], repo['path'])
-
-@task()
-def diff(ctx, config=None):
+    return repo['function'](repo['name'], repo['path'], stat=repo['stat'])
+
+@task(help={
+        'json': 'write one JSON object per repository',
+        'stream': 'write each repository as soon as it is finished',
+        'stat': 'show the changed files instead of their changes',
+        })
+def diff(ctx, config=None, json_=False, stream=False, stat=False):
     Config = read_config_file(config)
-    patches._pop()
-    p = Pool(MAX_PROCESSES)
+    with messages(json_):
+        patches._pop()
     repos = []
     for section in Config.sections():
         repo = get_repo(section, Config, 'diff')
+        repo['stat'] = stat
         if os.path.exists(repo['path']):
             repos.append(repo)
-    p.map(_diff, repos)
-    patches._push()
+    run_repos_output(_diff, repos, json_, stream)
+    with messages(json_):
+        patches._push()
 
 
 def git_pull(module, path, update=False, clean=False, branch=None,
         revision=None, ignore_missing=False):
     """
-    Params update, clean, branch and revision are not used.
+    Params update, clean and branch are not used. If revision is set it is
+    checked out instead of pulling the current branch.
     """
     print(t.bold('Pulling %s' % module))
     path_repo = os.path.join(path)
@@ -422,34 +740,31 @@ def git_pull(module, path, update=False, clean=False, branch=None,
             file=sys.stderr)
         return -1
 
-    cwd = os.getcwd()
-    os.chdir(path_repo)
-
-    cmd = ['git', 'pull']
-    result = run(' '.join(cmd), warn=True, hide='both')
+    # Do not change the working directory: it may be called from threads
+    if revision:
+        result = run('cd %s; git fetch && git checkout -q %s' % (path_repo,
+                revision), warn=True, hide='both')
+    else:
+        result = run('cd %s; git pull' % path_repo, warn=True, hide='both')
 
     if not result.ok:
         print(t.red("= " + module + " = KO!"), file=sys.stderr)
         print(result.stderr, file=sys.stderr)
-        os.chdir(cwd)
         return -1
 
     # If git outputs 'Already up-to-date' do not print anything.
     if ('Already up to date' in result.stdout
             or 'Already up-to-date' in result.stdout):
-        os.chdir(cwd)
         return 0
 
     print(t.bold("= " + module + " ="))
     print(result.stdout)
-    os.chdir(cwd)
     return 0
 
 
 def hg_check_url(module, path, url, clean=False):
 
-    repo = hgapi.Repo(path)
-    actual_url = str(repo.config('paths', 'default')).rstrip('/')
+    actual_url = hg_metadata(path)['default'].rstrip('/')
     url = str(url).rstrip('/')
     if actual_url != url:
         print((t.bold('[%s]' % module) +
@@ -472,6 +787,7 @@ def hg_clean(module, path, url, force=False):
         run('cd %s;hg update %s %s' % (path, update, nointeract),
             hide='stdout')
         run('cd %s;hg purge %s' % (path, nointeract), hide='stdout')
+        hg_metadata_changed(path)
     except:
         print(t.bold(module) + " module " + t.red("has uncommited changes"))
 
@@ -503,9 +819,9 @@ def clean(ctx, force=False, config=None, unstable=True):
 
 
 def hg_branches(module, path, config_branch=None):
-    client = hgapi.Repo(path)
-    branches = client.get_branch_names()
-    active = client.hg_branch()
+    metadata = hg_metadata(path)
+    branches = list(metadata['heads'])
+    active = metadata['branch']
     b = []
     branches.sort()
     branches.reverse()
@@ -532,13 +848,9 @@ def hg_branches(module, path, config_branch=None):
     print(msg)
 
 def git_branches(module, path, config_branch=None):
-    repo = git.Repo(path)
-    branches = repo.git.branch('-a')
-    branches = [x.replace('remotes/origin/','').replace('*','').strip()
-        for x in branches.split('\n') if 'HEAD' not in x]
-    active = branches[0]
+    active, branches = git_branch_table(path)
     b = []
-    branches = list(set(branches))
+    branches = list(branches)
     branches.sort()
     branches.reverse()
     for branch in branches:
@@ -564,12 +876,15 @@ def git_branches(module, path, config_branch=None):
 def _branches(repo):
     return repo['function'](repo['name'], repo['path'], repo['branch'])
 
-@task()
-def branches(ctx, config=None, modules=None):
+@task(help={
+        'json': 'write one JSON object per repository',
+        'stream': 'write each repository as soon as it is finished',
+        })
+def branches(ctx, config=None, modules=None, json_=False, stream=False):
 
-    patches._pop()
+    with messages(json_):
+        patches._pop()
     Config = read_config_file(config, unstable=True)
-    p = Pool(MAX_PROCESSES)
     repos = []
 
     for section in Config.sections():
@@ -578,7 +893,7 @@ def branches(ctx, config=None, modules=None):
         repo = get_repo(section, Config, 'branches')
         repos.append(repo)
 
-    p.map(_branches, repos)
+    run_repos_output(_branches, repos, json_, stream)
 
 @task()
 def branch(ctx, branch, clean=False, config=None, unstable=True):
@@ -621,17 +936,17 @@ def hg_pull(module, path, update=False, clean=False, branch=None,
         print(t.red("Missing repositori: ") + t.bold(path), file=sys.stderr)
         return -1
 
-    repo = hgapi.Repo(path)
     retries = 2
     while retries:
         retries -= 1
         try:
-            repo.hg_pull()
+            hg(path, 'pull')
+            hg_metadata_changed(path)
             if update:
                 return hg_update_ng(module, path, clean, branch=branch,
                     revision=revision, ignore_missing=ignore_missing)
             return 0
-        except hgapi.HgException as e:
+        except HgError as e:
             import traceback
             traceback.print_stack()
             if retries:
@@ -645,31 +960,108 @@ def hg_pull(module, path, update=False, clean=False, branch=None,
         except:
             return -1
 
+def git_remote_changed(module, path, url, branch=None):
+    """
+    Return False if the remote head of the current branch is already in the
+    local history, so there is nothing to pull.
+    """
+    if not os.path.exists(path):
+        return True
+    current = get_branch(path, 'git')
+    result = run('cd %s; git ls-remote origin refs/heads/%s' % (path,
+            current), warn=True, hide='both')
+    if not result.ok or not result.stdout.strip():
+        return True
+    head = result.stdout.split()[0]
+    result = run('cd %s; git merge-base --is-ancestor %s HEAD' % (path, head),
+        warn=True, hide='both')
+    return not result.ok
+
+
+def hg_remote_changed(module, path, url, branch=None):
+    """
+    Return False if the remote head of branch is already in the local
+    repository, so there is nothing to pull.
+    """
+    if not os.path.exists(path):
+        return True
+    branch = branch or DEFAULT_BRANCH['hg']
+    result = run('hg identify -r %s %s' % (branch, get_url(url)), warn=True,
+        hide='both')
+    if not result.ok or not result.stdout.strip():
+        return True
+    head = result.stdout.split()[0]
+    result = run('cd %s; hg log -r %s -T "{node}"' % (path, head), warn=True,
+        hide='both')
+    return not result.ok
+
+
+def _remote_changed(repo):
+    return eval('%s_remote_changed' % repo['type'])(repo['name'],
+        repo['path'], repo['url'], repo['branch'])
+
+
 def _pull(repo):
+    if repo.get('unchanged'):
+        # Nothing new upstream but the working copy may still have to be
+        # moved to the configured branch or revision
+        if repo['type'] == 'hg' and repo['update']:
+            return hg_update_ng(repo['name'], repo['path'], False,
+                branch=repo['branch'], revision=repo['revision'],
+                ignore_missing=repo['ignore_missing'])
+        if (repo['type'] == 'git' and repo['revision']
+                and git_revision(repo['name'], repo['path'])
+                != repo['revision']):
+            return git_pull(repo['name'], repo['path'],
+                revision=repo['revision'],
+                ignore_missing=repo['ignore_missing'])
+        return 0
     return repo['function'](repo['name'], repo['path'], update=repo['update'],
         branch=repo['branch'], revision=repo['revision'],
         ignore_missing=repo['ignore_missing'])
 
 
-@task()
+@task(help={
+        'json': 'write one JSON object per repository',
+        'stream': 'write each repository as soon as it is finished',
+        'modules': 'module names separated by coma',
+        })
 def pull(ctx, config=None, unstable=True, update=True, development=False,
-         ignore_missing=False, no_quilt=False):
-    if not no_quilt:
-        patches._pop()
-
+         ignore_missing=False, no_quilt=False, check_remote=True,
+         json_=False, stream=False, modules=None):
     Config = read_config_file(config, unstable=unstable)
-    p = Pool(MAX_PROCESSES)
     repos = []
     for section in Config.sections():
+        if modules and section not in modules.split(','):
+            continue
         # TODO: provably it could be done with a wrapper
         repo = get_repo(section, Config, 'pull', development)
         repo['update'] = update
         repo['ignore_missing'] = ignore_missing
         repos.append(repo)
-    exit_codes = p.map(_pull, repos)
 
     if not no_quilt:
-        patches._push()
+        with messages(json_):
+            # Only the patches of the pulled modules have to be removed
+            patches._pop(repos=[x['path'] for x in repos] if modules
+                else None)
+
+    p = Pool(MAX_PROCESSES)
+
+    if check_remote:
+        changed = p.map(_remote_changed, repos)
+        for repo, repo_changed in zip(repos, changed):
+            repo['unchanged'] = not repo_changed
+        with messages(json_):
+            print(t.bold('%d of %d pulls skipped (remote unchanged)' % (
+                        changed.count(False), len(repos))))
+    p.close()
+    results = run_repos_output(_pull, repos, json_, stream)
+    exit_codes = [r['result'] or 0 for r in results]
+
+    if not no_quilt:
+        with messages(json_):
+            patches._push()
     return sum(exit_codes)
 
 
@@ -691,24 +1083,87 @@ def hg_commit(module, path, msg):
     os.chdir(cwd)
 
 
+def hg_outgoing(path):
+    """
+    Return the number of changesets not yet pushed. It uses the draft phase
+    so the remote server is not contacted.
+    """
+    result = run('cd %s; hg log -r "draft()" -T "{node}\\n"' % path,
+        warn=True, hide='both')
+    if not result.ok:
+        return None
+    return len(result.stdout.split())
+
+
+def git_outgoing(path):
+    """
+    Return the number of commits not yet pushed to the upstream branch or None
+    if the branch has no upstream.
+    """
+    result = run('cd %s; git rev-list --count @{u}..HEAD' % path, warn=True,
+        hide='both')
+    if not result.ok:
+        return None
+    return int(result.stdout.strip() or 0)
+
+
 def hg_push(module, path, url, new_branches=False):
-    path_repo = os.path.join(path, module)
-    if not os.path.exists(path_repo):
-        print(t.red("Missing repositori: ") + t.bold(path_repo),
-            file=sys.stderr)
-        return
+    if not os.path.exists(path):
+        print(t.red("Missing repositori: ") + t.bold(path), file=sys.stderr)
+        return -1
 
-    cwd = os.getcwd()
-    os.chdir(path_repo)
+    if hg_outgoing(path) == 0:
+        return 0
 
     cmd = ['hg', 'push', url]
     if new_branches:
         cmd.append('--new-branch')
-    result = run(' '.join(cmd), warn=True, hide='both')
+    result = run('cd %s; %s' % (path, ' '.join(cmd)), warn=True, hide='both')
 
     print(t.bold("= " + module + " ="))
     print(result.stdout)
-    os.chdir(cwd)
+    # hg push exits with 1 when there is nothing to push
+    if result.exited > 1:
+        print(result.stderr, file=sys.stderr)
+        return -1
+    return 0
+
+
+def git_push(module, path, url, new_branches=False):
+    """
+    Branches without upstream are only pushed if new_branches is set.
+    """
+    if not os.path.exists(path):
+        print(t.red("Missing repositori: ") + t.bold(path), file=sys.stderr)
+        return -1
+
+    if git_branch_table(path)[0] is None:
+        print(t.bold("= " + module + " =") + " HEAD is detached, not pushed")
+        return 0
+
+    outgoing = git_outgoing(path)
+    if outgoing == 0:
+        return 0
+
+    cmd = ['git', 'push']
+    if outgoing is None:
+        if not new_branches:
+            print(t.bold("= " + module + " =") + " Branch has no upstream, "
+                "use --new-branches to push it")
+            return 0
+        cmd.extend(['-u', 'origin', 'HEAD'])
+    result = run('cd %s; %s' % (path, ' '.join(cmd)), warn=True, hide='both')
+
+    print(t.bold("= " + module + " ="))
+    print(result.stdout + result.stderr)
+    if not result.ok:
+        return -1
+    return 0
+
+
+def _push(repo):
+    return repo['function'](repo['name'], repo['path'], repo['url'],
+        repo['new_branches'])
 
 
 @task()
@@ -719,27 +1174,30 @@ def push(ctx, config=None, unstable=True, new_branches=False):
     url that start with http are excluded.
     '''
     Config = read_config_file(config, unstable=unstable)
-    processes = []
-    p = None
+    repos = []
     for section in Config.sections():
-        repo = Config.get(section, 'repo')
-        path = Config.get(section, 'path')
         # Don't push to repos that start with http as we don't have access to
-        url = Config.get(section, 'url')
-        if url[:4] == 'http':
+        if Config.get(section, 'url')[:4] == 'http':
             continue
-        if repo == 'hg':
-            func = hg_push
-        elif repo == 'git':
-            continue
-        else:
+        if Config.get(section, 'repo') not in ('hg', 'git'):
             print("Not developed yet", file=sys.stderr)
             continue
-        p = Process(target=func, args=(section, path, url, new_branches))
-        p.start()
-        processes.append(p)
-        wait_processes(processes)
-    wait_processes(processes, 0)
+        repo = get_repo(section, Config, 'push')
+        repo['new_branches'] = new_branches
+        repos.append(repo)
+
+    results = run_repos(_push, repos)
+    exit_code = 0
+    for repo, (res, elapsed) in zip(repos, results):
+        if res:
+            exit_code = -1
+            print(t.red('%-40s %6.2fs KO' % (repo['name'], elapsed)),
+                file=sys.stderr)
+        elif elapsed >= 1:
+            print('%-40s %6.2fs' % (repo['name'], elapsed))
+    if exit_code:
+        print(t.bold_red('Push Task finished with errors!'))
+    return exit_code
 
 
 def hg_update_ng(module, path, clean, branch=None, revision=None,
@@ -750,21 +1208,21 @@ def hg_update_ng(module, path, clean, branch=None, revision=None,
         print(t.red("Missing repositori: ") + t.bold(path), file=sys.stderr)
         return
 
-    repo = hgapi.Repo(path)
     if revision and branch:
-        if repo.revision(revision).branch != branch:
-            print(t.bold_red('[' + module + ']'))
-            print(("Invalid revision '%s': it isn't in branch '%s'"
-                % (revision, branch)))
+        if check_revision(path, module, revision, branch):
             return -1
     elif branch:
         revision = branch
     elif not revision:
-        revision = repo.hg_branch()
+        revision = hg_metadata(path)['branch']
 
     try:
-        repo.hg_update(revision, clean)
-    except hgapi.HgException as e:
+        cmd = ['update', revision]
+        if clean:
+            cmd.append('--clean')
+        hg(path, *cmd)
+        hg_metadata_changed(path)
+    except HgError as e:
         print(t.bold_red('[' + module + ']'))
         print("Error running %s: %s" % (e.exit_code, str(e)))
         return -1
@@ -820,16 +1278,22 @@ def hg_update(module, path, clean, branch=None, revision=None,
     os.chdir(cwd)
 
 
-@task()
+@task(help={
+        'modules': 'module names separated by coma',
+        })
 def update(ctx, config=None, unstable=True, clean=False, development=True,
-        no_quilt=False):
+        no_quilt=False, modules=None):
+    Config = read_config_file(config, unstable=unstable)
+    sections = [x for x in Config.sections()
+        if not modules or x in modules.split(',')]
     if not no_quilt:
-        patches._pop()
+        # Only the patches of the updated modules have to be removed
+        patches._pop(repos=[get_repo(x, Config)['path'] for x in sections]
+            if modules else None)
 
-    Config = read_config_file(config, unstable=unstable)
     processes = []
     p = None
-    for section in Config.sections():
+    for section in sections:
         repo = get_repo(section, Config, 'update')
         branch = None
         if clean:
@@ -847,35 +1311,123 @@ def update(ctx, config=None, unstable=True, clean=False, development=True,
         patches._push()
 
 
-def git_revision(module, path, verbose):
-    print("Git revision not implented")
+def _git_dir(path):
+    """
+    Return the git directory of the work tree in path and the one shared by
+    its work trees, which holds the branches.
+    """
+    git_dir = os.path.join(path, '.git')
+    if os.path.isfile(git_dir):
+        # Work trees and submodules have a file pointing to their git dir
+        with open(git_dir) as f:
+            line = f.readline().strip()
+        if not line.startswith('gitdir:'):
+            return None, None
+        git_dir = os.path.join(path, line[len('gitdir:'):].strip())
+    if not os.path.isdir(git_dir):
+        return None, None
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def _git_packed_refs(common_dir):
+    refs = {}
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as f:
+            for line in f:
+                # Skip the header and the peeled tags
+                if line.startswith(('#', '^')):
+                    continue
+                sha, _, ref = line.strip().partition(' ')
+                if ref:
+                    refs[ref] = sha
+    except FileNotFoundError:
+        pass
+    return refs
+
+
+def _git_read_ref(git_dir, common_dir, ref, packed_refs=None):
+    """
+    Return the commit of ref (e.g. 'HEAD' or 'refs/heads/main') following
+    symbolic refs, or None if it can not be resolved.
+    """
+    for _ in range(10):
+        # HEAD is per work tree, branches are shared
+        base = git_dir if ref == 'HEAD' else common_dir
+        try:
+            with open(os.path.join(base, ref)) as f:
+                value = f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            if packed_refs is None:
+                packed_refs = _git_packed_refs(common_dir)
+            return packed_refs.get(ref)
+        if not value.startswith('ref:'):
+            return value or None
+        ref = value[len('ref:'):].strip()
+    return None
+
+
+def git_branch_table(path):
+    """
+    Return the active branch (None if HEAD is detached) and the set of local
+    and origin branches of the git repository in path.
+    """
+    git_dir, common_dir = _git_dir(path)
+    if git_dir is None:
+        return None, set()
+    branches = set()
+    for prefix in ('refs/heads/', 'refs/remotes/origin/'):
+        for ref in _git_packed_refs(common_dir):
+            if ref.startswith(prefix):
+                branches.add(ref[len(prefix):])
+        base = os.path.join(common_dir, prefix)
+        for root, _, files in os.walk(base):
+            for name in files:
+                branches.add(os.path.relpath(os.path.join(root, name), base)
+                    .replace(os.sep, '/'))
+    branches.discard('HEAD')
+    active = None
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except FileNotFoundError:
+        head = ''
+    if head.startswith('ref: refs/heads/'):
+        active = head[len('ref: refs/heads/'):]
+        branches.add(active)
+    return active, branches
+
+
+def git_revision(module, path, verbose=False):
+    if not os.path.exists(path):
+        print((t.red("Missing repositori: ")
+            + t.bold(path)), file=sys.stderr)
+        return False
+    git_dir, common_dir = _git_dir(path)
+    if git_dir is None:
+        return False
+    return _git_read_ref(git_dir, common_dir, 'HEAD') or False
 
 def hg_revision(module, path, verbose=False):
-    t = Terminal()
     path_repo = path
     if not os.path.exists(path_repo):
         print((t.red("Missing repositori: ")
             + t.bold(path_repo)), file=sys.stderr)
         return False
 
-    repo = hgapi.Repo(path_repo)
-    branches = repo.get_branches()
-    revision = False
-    for branch in branches:
-        if branch['name'] == repo.hg_branch():
-            revision = branch['version'].split(':')[1]
-
-    return revision
+    metadata = hg_metadata(path_repo)
+    return metadata['heads'].get(metadata['branch'], False)
 
 
 def hg_is_last_revision(path, revision):
     if not revision:
         return False
     try:
-        repo = hgapi.Repo(path)
-        rev = repo.revision(revision)
-        rev2 = repo.revision(repo.hg_id())
-        if rev.date == rev2.date:
+        date = hg(path, 'log', '-r', revision, '-T', '{date}')
+        if date == hg(path, 'log', '-r', '.', '-T', '{date}'):
             return False
     except:
         return False
@@ -883,38 +1435,66 @@ def hg_is_last_revision(path, revision):
 
 
 @task()
-def fetch(ctx):
-    patches._pop()
-
-    print(t.bold('Pulling...'))
-    pull(ctx, update=True, ignore_missing=True, no_quilt=True)
+def fetch(ctx, check_remote=True):
+    """
+    Pull existing repositories while cloning the missing ones, then install
+    the requirements of config, tasks and the project from their wheelhouse.
+    """
+    timings = []
+    with timing(timings, 'Pop patches'):
+        patches._pop()
 
-    print(t.bold('Cloning...'))
-    clone(ctx)
+    with timing(timings, 'Update config'):
+        git_pull('config', 'config', True)
 
-    patches._push()
+    Config = read_config_file(unstable=True)
+    pull_repos, clone_repos = [], []
+    for section in Config.sections():
+        repo = get_repo(section, Config, 'pull')
+        if os.path.exists(repo['path']):
+            repo['update'] = True
+            repo['ignore_missing'] = True
+            pull_repos.append(repo)
+        else:
+            clone_repos.append(get_repo(section, Config, 'clone'))
+
+    print(t.bold('Pulling %d and cloning %d repositories...' % (
+                len(pull_repos), len(clone_repos))))
+    # Clones have their own pool so they run while the existing repos are
+    # pulled instead of queueing ahead of them
+    clone_pool = Pool(max(1, min(MAX_PROCESSES, len(clone_repos))))
+    clone_start = time.time()
+    clone_end = []
+    cloning = clone_pool.map_async(_clone, clone_repos,
+        callback=lambda result: clone_end.append(time.time()))
+    p = Pool(MAX_PROCESSES)
+    with timing(timings, 'Pull'):
+        if check_remote:
+            changed = p.map(_remote_changed, pull_repos)
+            for repo, repo_changed in zip(pull_repos, changed):
+                repo['unchanged'] = not repo_changed
+            print(t.bold('%d of %d pulls skipped (remote unchanged)' % (
+                        changed.count(False), len(pull_repos))))
+        exit_codes = p.map(_pull, pull_repos)
+    p.close()
+    exit_codes += cloning.get()
+    clone_pool.close()
+    timings.append(('Clone', clone_end[0] - clone_start))
+    if sum(exit_codes, 0) < 0:
+        print(t.bold_red('Fetch finished with errors!'))
+
+    with timing(timings, 'Symlinks'):
+        reconcile_symlinks()
+
+    with timing(timings, 'Push patches'):
+        patches._push()
 
     print(t.bold('Updating requirements...'))
-    bashCommand = ['pip', 'install', '-r', 'config/requirements.txt',
-        '--exists-action','s']
-    execBashCommand(bashCommand,
-        'Config Requirements Installed Succesfully',
-        "It's not possible to apply patche(es)")
-
-    bashCommand = ['pip', 'install', '-r', 'tasks/requirements.txt',
-        '--exists-action','s']
-    execBashCommand(bashCommand,
-        'Tasks Requirements Installed Succesfully',
-        "It's not possible to apply patche(es)")
-
-    if os.path.isfile('requirements.txt'):
-        bashCommand = ['pip', 'install', '-r', 'requirements.txt',
-            '--exists-action','s']
-        execBashCommand(bashCommand,
-            'Root Requirements Installed Succesfully',
-            "It's not possible to apply patche(es)")
+    with timing(timings, 'Requirements'):
+        install_requirements_offline()
 
     print(t.bold('Fetched.'))
+    print_timings(timings)
 
 
 def _module_version(modules):
@@ -953,6 +1533,164 @@ def module_version(ctx, config=None):
         print(section, version)
 
 
+def _release_journal(branch):
+    return '.release-%s.journal' % branch
+
+
+def _read_release_journal(journal):
+    done = {}
+    if not os.path.exists(journal):
+        return done
+    with open(journal) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            module, step = line.split('\t', 1)
+            done.setdefault(module, set()).add(step)
+    return done
+
+
+def _set_module_version(path, version):
+    cfg_file = os.path.join(path, 'tryton.cfg')
+    with open(cfg_file) as f:
+        content = f.read()
+    content = re.sub(r'^version\s*=.*$', 'version=%s' % version, content,
+        flags=re.MULTILINE)
+    with open(cfg_file, 'w') as f:
+        f.write(content)
+
+
+def git_release_branch(module, path, branch, version, next_version,
+        main_branch, done, journal):
+    """
+    Cut the release branch of a module: create the branch with the release
+    version and increase the version on the main branch. Each step is
+    recorded in the journal so a failed run can be resumed.
+    """
+    def step(name, commands):
+        if name in done:
+            return True
+        for cmd in commands:
+            if callable(cmd):
+                cmd()
+                continue
+            result = run('cd %s; %s' % (path, cmd), warn=True, hide='both')
+            if not result.ok:
+                print(t.red("= " + module + " = KO! (%s)" % name),
+                    file=sys.stderr)
+                print(result.stderr, file=sys.stderr)
+                return False
+        # Small appends are atomic so workers can share the journal
+        with open(journal, 'a') as f:
+            f.write('%s\t%s\n' % (module, name))
+        return True
+
+    exists = run('cd %s; git rev-parse --verify --quiet refs/heads/%s'
+        % (path, branch), warn=True, hide='both').ok
+    steps = [
+        # The release branch is cut from the main branch, whatever the
+        # module has checked out
+        ('branch', ['git checkout %s' % branch if exists
+                else 'git checkout -b %s %s' % (branch, main_branch)]),
+        ('branch_version', [
+                'git checkout %s' % branch,
+                lambda: _set_module_version(path, version),
+                'git diff --quiet HEAD || git commit -a -m "Branch %s"'
+                % branch,
+                ]),
+        ('main_version', [
+                'git checkout %s' % main_branch,
+                lambda: _set_module_version(path, next_version),
+                'git diff --quiet HEAD || '
+                'git commit -a -m "Increase version number"',
+                ]),
+        ]
+    for name, commands in steps:
+        if not step(name, commands):
+            return -1
+    return 0
+
+
+def _release_branch(repo):
+    return git_release_branch(repo['name'], repo['path'], repo['release'],
+        repo['version'], repo['next_version'], repo['main_branch'],
+        repo['done'], repo['journal'])
+
+
+def git_release_push(module, path, branch, main_branch, done, journal):
+    if 'push' in done:
+        return 0
+    # Push both branches at once instead of one push per commit
+    result = run('cd %s; git push -u origin %s %s' % (path, branch,
+            main_branch), warn=True, hide='both')
+    if not result.ok:
+        print(t.red("= " + module + " = KO! (push)"), file=sys.stderr)
+        print(result.stderr, file=sys.stderr)
+        return -1
+    with open(journal, 'a') as f:
+        f.write('%s\tpush\n' % module)
+    return 0
+
+
+def _release_push(repo):
+    return git_release_push(repo['name'], repo['path'], repo['release'],
+        repo['main_branch'], repo['done'], repo['journal'])
+
+
+@task()
+def release_branch(ctx, branch, next_version, version=None, config=None,
+        unstable=True, modules=None, main_branch=DEFAULT_BRANCH['git'],
+        push=True):
+    '''
+    Create the release branch on all git modules.
+
+    The release branch gets version (by default "<branch>.0") and
+    main_branch is increased to next_version. Steps already done are read
+    from the .release-<branch>.journal file, so running the task again
+    resumes an interrupted branch cut.
+    '''
+    if version is None:
+        version = branch + '.0'
+    journal = _release_journal(branch)
+    done = _read_release_journal(journal)
+
+    Config = read_config_file(config, unstable=unstable)
+    repos = []
+    for section in Config.sections():
+        if modules and section not in modules.split(','):
+            continue
+        repo = get_repo(section, Config)
+        if repo['type'] != 'git':
+            continue
+        if not os.path.exists(os.path.join(repo['path'], 'tryton.cfg')):
+            continue
+        repo['release'] = branch
+        repo['version'] = version
+        repo['next_version'] = next_version
+        repo['main_branch'] = main_branch
+        repo['done'] = done.get(section, set())
+        repo['journal'] = journal
+        repos.append(repo)
+
+    p = Pool(MAX_PROCESSES)
+    exit_codes = p.map(_release_branch, repos)
+    failed = [r['name'] for r, code in zip(repos, exit_codes) if code]
+
+    if push:
+        to_push = [r for r, code in zip(repos, exit_codes) if not code]
+        exit_codes = p.map(_release_push, to_push)
+        failed += [r['name'] for r, code in zip(to_push, exit_codes) if code]
+
+    if failed:
+        print(t.bold_red('Release branch failed on: ') + ', '.join(failed))
+        print('Run the task again to resume from %s' % journal)
+        return -1
+    print(t.bold('Release branch %s created on %d modules' % (branch,
+                len(repos))))
+    return 0
+
+
 ScmCollection = Collection()
 ScmCollection.add_task(clone)
 ScmCollection.add_task(status)
@@ -966,3 +1704,5 @@ ScmCollection.add_task(module_diff)
 ScmCollection.add_task(clean)
 ScmCollection.add_task(branches)
 ScmCollection.add_task(module_version)
+ScmCollection.add_task(release_branch)
+ScmCollection.add_task(symlinks)
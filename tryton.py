@@ -1,55 +1,38 @@
 #!/usr/bin/env python
 import contextlib
 import os
-import psycopg2
 import sys
 import socket
 import getpass
 from invoke import task, Collection
 
 from .iban import create_iban, IBANError
-from .utils import t
+from .utils import t, lazy_import, proteus
 from functools import reduce
 
-try:
-    from trytond.pool import Pool
-    from trytond.transaction import Transaction
-    from trytond.modules import Graph, Node, get_module_info
-except ImportError:
-    print("trytond importation error: ", file=sys.stderr)
-
-try:
-    from proteus import config as pconfig, Wizard, Model,  __version__ as proteus_version
-except ImportError:
-    proteus_version = '3.4'
-    proteus_path = os.path.abspath(os.path.normpath(os.path.join(os.getcwd(),
-                'proteus')))
-    if os.path.isdir(proteus_path):
-        sys.path.insert(0, proteus_path)
-    try:
-        from proteus import config as pconfig, Wizard, Model
-    except ImportError as e:
-        print("proteus importation error: ", e, file=sys.stderr)
+# trytond and proteus are only imported when a task uses them
+psycopg2 = lazy_import('psycopg2')
+
 
-try:
+def get_proteus_version():
+    return getattr(proteus, '__version__', '3.4')
+
+
+def get_ir_module():
     from sql import Table
-    if proteus_version < '4.0':
-        ir_module = Table('ir_module_module')
-    else:
-        ir_module = Table('ir_module')
-    ir_model_data = Table('ir_model_data')
-except ImportError:
-    ir_module = None
-    ir_model_data = None
-
-try:
-    # TODO: Remove compatibility with versions < 3.4
-    from trytond.config import CONFIG
-except ImportError:
+    if get_proteus_version() < '4.0':
+        return Table('ir_module_module')
+    return Table('ir_module')
+
+
+def get_trytond_config():
     try:
+        # TODO: Remove compatibility with versions < 3.4
+        from trytond.config import CONFIG
+    except ImportError:
         from trytond.config import config as CONFIG
-    except ImportError as e:
-        print("trytond importation error: ", e, file=sys.stderr)
+    return CONFIG
+
 
 trytond_path = os.path.abspath(os.path.normpath(os.path.join(os.getcwd(),
             'trytond')))
@@ -75,7 +58,9 @@ def check_database(database, connection_params):
 
 
 def set_context(database_name, config_file=os.environ.get('TRYTOND_CONFIG')):
-    CONFIG.update_etc(config_file)
+    from trytond.transaction import Transaction
+
+    get_trytond_config().update_etc(config_file)
     if not Transaction().connection:
         return Transaction().start(database_name, 0)
     else:
@@ -85,6 +70,8 @@ def set_context(database_name, config_file=os.environ.get('TRYTOND_CONFIG')):
 
 
 def create_graph(module_list):
+    from trytond.modules import Graph, Node, get_module_info
+
     graph = Graph()
     packages = []
 
@@ -163,12 +150,13 @@ def uninstall_task(ctx, database, modules,
     if not check_database(database, {}):
         return
 
-    config = pconfig.set_trytond(database=database, config_file=config_file)
+    config = proteus.config.set_trytond(database=database,
+        config_file=config_file)
 
-    if proteus_version < '3.5':
-        Module = Model.get('ir.module.module')
+    if get_proteus_version() < '3.5':
+        Module = proteus.Model.get('ir.module.module')
     else:
-        Module = Model.get('ir.module')
+        Module = proteus.Model.get('ir.module')
 
     modules_to_uninstall = Module.find([
             ('name', 'in', modules),
@@ -177,10 +165,11 @@ def uninstall_task(ctx, database, modules,
     Module.deactivate([m.id for m in modules_to_uninstall],
         config.context)
 
-    if proteus_version < '3.5':
-        module_install_upgrade = Wizard('ir.module.module.install_upgrade')
+    if get_proteus_version() < '3.5':
+        module_install_upgrade = proteus.Wizard(
+            'ir.module.module.install_upgrade')
     else:
-        module_install_upgrade = Wizard('ir.module.install_upgrade')
+        module_install_upgrade = proteus.Wizard('ir.module.install_upgrade')
     module_install_upgrade.execute('upgrade')
     module_install_upgrade.execute('config')
     print("")
@@ -199,7 +188,10 @@ def delete_modules(ctx, database, modules,
     if isinstance(modules, str):
         modules = modules.split(',')
 
+    from trytond.transaction import Transaction
+
     print(t.bold("delete: ") + ", ".join(modules))
+    ir_module = get_ir_module()
     set_context(database, config_file)
     cursor = Transaction().connection.cursor()
     cursor.execute(*ir_module.select(ir_module.name,
@@ -232,9 +224,9 @@ def convert_bank_accounts_to_iban(ctx, database,
     if not check_database(database, {}):
         return
 
-    pconfig.set_trytond(database=database, config_file=config_file)
+    proteus.config.set_trytond(database=database, config_file=config_file)
 
-    BankAccount = Model.get('bank.account')
+    BankAccount = proteus.Model.get('bank.account')
     bank_accounts = BankAccount.find([
             ('numbers.type', '=', 'other'),
             ])
@@ -282,10 +274,11 @@ def automatic_reconciliation(ctx, database, max_lines=4,
     if not check_database(database, {}):
         return
 
-    config = pconfig.set_trytond(database=database, config_file=config_file)
-    Company = Model.get('company.company')
-    FiscalYear = Model.get('account.fiscalyear')
-    User = Model.get('res.user')
+    config = proteus.config.set_trytond(database=database,
+        config_file=config_file)
+    Company = proteus.Model.get('company.company')
+    FiscalYear = proteus.Model.get('account.fiscalyear')
+    User = proteus.Model.get('res.user')
 
     companies = Company.find([])
     fiscal_years = FiscalYear.find([('state', '=', 'open')])
@@ -311,7 +304,7 @@ def automatic_reconciliation(ctx, database, max_lines=4,
             for max_lines in (2, 3, 4):
                 print("    - Reconcile year %s using %s lines" % (
                     fiscal_year.name, max_lines))
-                automatic_reconcile = Wizard('account.move_reconcile')
+                automatic_reconcile = proteus.Wizard('account.move_reconcile')
                 assert automatic_reconcile.form.company == company, \
                     'Unexpected company "%s" (%s)' % (
                         automatic_reconcile.form.company, company)
@@ -337,7 +330,10 @@ def adduser(ctx, dbname, user, conf_file=None):
     if not os.path.isfile(conf_file):
         print(t.red("File '%s' not found" % (conf_file)))
         return
-    CONFIG.update_etc(conf_file)
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    get_trytond_config().update_etc(conf_file)
 
     Pool.start()
     pool = Pool(dbname)
@@ -1,23 +1,63 @@
-from blessings import Terminal
 from invoke import task, Collection
 from path import Path
 import configparser
+import hashlib
+import importlib.util
 import os
-import psycopg2
 import shutil
 import subprocess
 import sys
+import time
+from contextlib import contextmanager
+
+
+
+def lazy_import(name):
+    """
+    Return the module name without executing it until one of its attributes
+    is used, so importing the tasks does not pay for modules that are not
+    needed. Raises ImportError if the module is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %r' % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class LazyTerminal(object):
+    """
+    blessings' Terminal created the first time it is used
+    """
+    def __init__(self):
+        self._terminal = None
+
+    def __getattr__(self, name):
+        if self._terminal is None:
+            from blessings import Terminal
+            self._terminal = Terminal()
+        return getattr(self._terminal, name)
+
+
+psycopg2 = lazy_import('psycopg2')
 
 try:
-    from proteus import config, Wizard, Model
+    proteus = lazy_import('proteus')
 except ImportError:
     proteus_path = os.path.abspath(os.path.normpath(os.path.join(os.getcwd(),
                 'proteus')))
     if os.path.isdir(proteus_path):
         sys.path.insert(0, proteus_path)
     try:
-        from proteus import config, Wizard, Model
+        proteus = lazy_import('proteus')
     except ImportError as e:
+        proteus = None
         print("proteus importation error: ", e, file=sys.stderr)
 
 trytond_path = os.path.abspath(os.path.normpath(os.path.join(os.getcwd(),
@@ -29,7 +69,11 @@ NO_MODULE_REPOS = ['trytond', 'tryton', 'proteus', 'nereid_app', 'sao',
     'tasks', 'utils', 'config', 'patches']
 BASE_MODULES = ['ir', 'res', 'tests', 'webdav']
 CORE_FILES = ['core.cfg']
-t = Terminal()
+REQUIREMENTS_FILES = ['config/requirements.txt', 'tasks/requirements.txt',
+    'requirements.txt']
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+        os.path.expanduser('~/.cache')), 'tryton-tasks')
+t = LazyTerminal()
 
 
 def _exit(initial_path, message=None):
@@ -40,8 +84,18 @@ def _exit(initial_path, message=None):
     sys.exit(message)
 
 
-def _ask_ok(prompt, default_answer=None):
-    ok = input(prompt) or default_answer
+def _ask(prompt, default_answer=''):
+    """
+    Ask the user unless TRYTON_TASKS_NONINTERACTIVE is set, in which case
+    the default answer is used.
+    """
+    if os.environ.get('TRYTON_TASKS_NONINTERACTIVE'):
+        return default_answer
+    return input(prompt) or default_answer
+
+
+def _ask_ok(prompt, default_answer='n'):
+    ok = _ask(prompt, default_answer)
     if ok.lower() in ('y', 'ye', 'yes'):
         return True
     if ok.lower() in ('n', 'no', 'nop', 'nope'):
@@ -156,9 +210,9 @@ def prepare_translations(ctx, database, langs=None, host=None, port=None,
     if not _check_database(database, host, port, dbuser, dbpassword):
         return
 
-    config.set_trytond(database=database, config_file=config_file)
+    proteus.config.set_trytond(database=database, config_file=config_file)
 
-    Lang = Model.get('ir.lang')
+    Lang = proteus.Model.get('ir.lang')
     if langs is None:
         languages = Lang.find([
                 ('translatable', '=', True),
@@ -172,16 +226,16 @@ def prepare_translations(ctx, database, langs=None, host=None, port=None,
             print(t.bold('Invalid languages: %s') % languages)
             return
 
-    translation_set = Wizard('ir.translation.set')
+    translation_set = proteus.Wizard('ir.translation.set')
     translation_set.execute('set_')
     translation_set.execute('end')
 
-    translation_clean = Wizard('ir.translation.clean')
+    translation_clean = proteus.Wizard('ir.translation.clean')
     translation_clean.execute('clean')
     translation_clean.execute('end')
 
     for language in languages:
-        translation_update = Wizard('ir.translation.update')
+        translation_update = proteus.Wizard('ir.translation.update')
         translation_update.form.language = language
         translation_update.execute('update')
         print("%s translation updated" % language.name)
@@ -202,13 +256,13 @@ def export_translations(ctx,database, modules, langs=None,
     if not _check_database(database, host, port, dbuser, dbpassword):
         return
 
-    config.set_trytond(database=database, config_file=config_file)
+    proteus.config.set_trytond(database=database, config_file=config_file)
 
     try:
-        Module = Model.get('ir.module')
+        Module = proteus.Model.get('ir.module')
     except KeyError:
         # Compatibility with versions older than 3.8
-        Module = Model.get('ir.module.module')
+        Module = proteus.Model.get('ir.module.module')
     if modules == 'all':
         ir_modules = Module.find([
                 ('state', 'in', ['installed', 'activated']),
@@ -224,7 +278,7 @@ def export_translations(ctx,database, modules, langs=None,
             print(t.bold('Invalid modules: %s') % missing_modules)
             return
 
-    Lang = Model.get('ir.lang')
+    Lang = proteus.Model.get('ir.lang')
     if langs is None:
         languages = Lang.find([
                 ('translatable', '=', True),
@@ -248,7 +302,7 @@ def export_translations(ctx,database, modules, langs=None,
             if language.code == 'en_US':
                 continue
 
-            translation_export = Wizard('ir.translation.export')
+            translation_export = proteus.Wizard('ir.translation.export')
             translation_export.form.language = language
             translation_export.form.module = module
             translation_export.execute('export')
@@ -268,10 +322,11 @@ def export_translations(ctx,database, modules, langs=None,
 def account_reconcile(ctx, database, lines=2, months=6,
         config_file=os.environ.get('TRYTOND_CONFIG')):
 
-    pref = config.set_trytond(database=database, config_file=config_file)
+    pref = proteus.config.set_trytond(database=database,
+        config_file=config_file)
 
-    Module = Model.get('ir.module.module')
-    Company = Model.get('company.company')
+    Module = proteus.Model.get('ir.module.module')
+    Company = proteus.Model.get('company.company')
 
     modules = Module.find([
                 ('name', '=', 'account_reconcile'),
@@ -282,13 +337,13 @@ def account_reconcile(ctx, database, lines=2, months=6,
     reconcile, = modules
     if reconcile.state != 'installed':
         Module.install([reconcile.id], pref.context)
-        Wizard('ir.module.module.install_upgrade').execute('upgrade')
+        proteus.Wizard('ir.module.module.install_upgrade').execute('upgrade')
 
     for company in Company.find([]):
         print(t.bold('Start reconcile for company %s (Lines %s, Months %s)'
             % (company.rec_name, lines, months)))
         with pref.set_context({'company': company.id}):
-            reconcile = Wizard('account.move_reconcile')
+            reconcile = proteus.Wizard('account.move_reconcile')
             reconcile.form.max_lines = str(lines)
             reconcile.form.max_months = months
             reconcile.form.start_date = None
@@ -336,6 +391,130 @@ def execBashCommand(command, success_msg="", fail_msg="", quiet=True):
     return True
 
 
+def get_cache_dir(*names):
+    """ Return (and create if needed) a directory inside the tasks cache """
+    path = os.path.join(CACHE_DIR, *names)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def hash_files(filenames):
+    """ Return a hash of the names and contents of the existing files """
+    digest = hashlib.sha1()
+    for filename in sorted(filenames):
+        if not os.path.isfile(filename):
+            continue
+        digest.update(filename.encode('utf-8'))
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_requirements_files():
+    return [x for x in REQUIREMENTS_FILES if os.path.isfile(x)]
+
+
+def get_wheelhouse(key):
+    return os.path.join(CACHE_DIR, 'wheelhouse', key)
+
+
+def build_wheelhouse(requirements_files=None):
+    """
+    Build the wheels of the requirements in a wheelhouse of the tasks cache
+    named after the hash of the requirements files, unless it already
+    exists. Returns the key of the wheelhouse or None if it failed.
+    """
+    if requirements_files is None:
+        requirements_files = get_requirements_files()
+    key = hash_files(requirements_files)
+    path = get_wheelhouse(key)
+    if os.path.isdir(path):
+        return key
+
+    build_path = path + '.tmp'
+    if os.path.exists(build_path):
+        shutil.rmtree(build_path)
+    os.makedirs(build_path)
+    command = ['pip', 'wheel', '--wheel-dir', build_path]
+    for requirements in requirements_files:
+        command.extend(['-r', requirements])
+    if subprocess.call(command):
+        shutil.rmtree(build_path)
+        return None
+    os.rename(build_path, path)
+    return key
+
+
+def install_requirements_offline(requirements_files=None):
+    """
+    Install the requirements from their wheelhouse without using the
+    package index. Nothing is done if the same files were already installed
+    in the current environment.
+    """
+    if requirements_files is None:
+        requirements_files = get_requirements_files()
+    key = hash_files(requirements_files)
+    # One stamp for each set of files so installing another set does not
+    # invalidate it
+    files_key = hashlib.sha1('\0'.join(sorted(os.path.abspath(x)
+                for x in requirements_files)).encode('utf-8')).hexdigest()
+    stamp = os.path.join(os.environ.get('VIRTUAL_ENV', sys.prefix),
+        '.tryton-tasks-requirements-%s' % files_key[:12])
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            if f.read().strip() == key:
+                print('Requirements already installed')
+                return True
+
+    if not build_wheelhouse(requirements_files):
+        print(t.red("It's not possible to build the requirements wheels"))
+        return False
+    command = ['pip', 'install', '--no-index', '--find-links',
+        get_wheelhouse(key), '--exists-action', 's']
+    for requirements in requirements_files:
+        command.extend(['-r', requirements])
+    if subprocess.call(command):
+        print(t.red("It's not possible to install requirements"))
+        return False
+    try:
+        with open(stamp, 'w') as f:
+            f.write(key)
+    except OSError:
+        pass
+    print('Requirements Installed Succesfully')
+    return True
+
+
+@task()
+def wheelhouse(ctx):
+    """
+    Build the wheelhouse of the config, tasks and project requirements
+    """
+    key = build_wheelhouse()
+    if not key:
+        _exit(os.getcwd(), "It's not possible to build the wheelhouse")
+    print(get_wheelhouse(key))
+
+
+@contextmanager
+def timing(timings, name):
+    """
+    Append to timings the (name, elapsed seconds) of the enclosed block.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.append((name, time.time() - start))
+
+
+def print_timings(timings):
+    print(t.bold('Timings:'))
+    for name, elapsed in timings:
+        print('  %-30s %8.2fs' % (name, elapsed))
+
+
 def remove_dir(path, quiet=False):
     if not quiet:
         if not _ask_ok('Answer "yes" to remove path: "%s". [y/N] ' %
@@ -344,8 +523,45 @@ def remove_dir(path, quiet=False):
     shutil.rmtree(path)
 
 
+@task()
+def import_time(ctx, budget=0.5, top=10):
+    """
+    Measure the time needed to import the tasks with "python -X importtime"
+    and fail if it is over budget seconds.
+    """
+    package_path = os.path.dirname(os.path.abspath(__file__))
+    package = os.path.basename(package_path)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            'import %s' % package], cwd=os.path.dirname(package_path),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if process.returncode:
+        print(process.stderr, file=sys.stderr)
+        _exit(os.getcwd(), 'Importing %s failed' % package)
+
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        imports.append((int(cumulative) / 1000000., name.rstrip()))
+    total = max(x for x, name in imports if name.strip() == package)
+
+    print(t.bold('Slowest imports:'))
+    for elapsed, name in sorted(imports, reverse=True)[:top]:
+        print('  %8.3fs %s' % (elapsed, name))
+    print(t.bold('Importing %s took %.3fs (budget %.3fs)' % (package, total,
+                float(budget))))
+    if total > float(budget):
+        _exit(os.getcwd(), 'Import time over budget')
+
+
 UtilsCollection = Collection()
 UtilsCollection.add_task(account_reconcile)
 UtilsCollection.add_task(update_parent_left_right)
 UtilsCollection.add_task(prepare_translations)
 UtilsCollection.add_task(export_translations)
+UtilsCollection.add_task(wheelhouse)
+UtilsCollection.add_task(import_time)
@@ -1,5 +1,17 @@
+import atexit
+import configparser
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
 import os
+import re
+import signal
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
     '..', 'trytond', 'trytond')))
@@ -8,6 +20,34 @@ if os.path.isdir(DIR):
 
 from trytond.config import config
 
+try:
+    import mod_wsgi
+except ImportError:
+    mod_wsgi = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def get_config_file():
+    '''
+    Return the trytond configuration file available when the module is
+    imported: TRYTOND_CONFIG environment variable or, when running inside a
+    mod_wsgi daemon, the file named after its process group in
+    TRYTOND_CONFIG_DIR (/etc/trytond by default).
+    '''
+    config_file = os.environ.get('TRYTOND_CONFIG')
+    if config_file:
+        return config_file
+    if mod_wsgi and mod_wsgi.process_group:
+        config_file = os.path.join(
+            os.environ.get('TRYTOND_CONFIG_DIR', '/etc/trytond'),
+            '%s.conf' % mod_wsgi.process_group)
+        if os.path.isfile(config_file):
+            return config_file
+
 
 class Application(object):
     '''
@@ -19,24 +59,588 @@ class Application(object):
     to workaround that limitation somehow and this class allows administrators
     to add 'Set Env trytond.config /etc/trytond/whatever.conf' to Apache's
     virtual host.
+
+    If the configuration file is known when the module is imported the
+    application can be preloaded instead, so the first request after each
+    worker recycle does not pay for the imports and the pool initialization.
     '''
     def __init__(self):
         self.loaded = False
         self.app = None
+        self.lock = threading.Lock()
 
-    def __call__(self, environ, start_response):
-        if not self.loaded:
-            config.update_etc(environ.get('trytond.config'))
+    def load(self, config_file=None):
+        with self.lock:
+            # Another thread may have loaded it while waiting for the lock
+            if self.loaded:
+                return
+            config.update_etc(config_file)
             logconf = config.get('optional', 'logconf')
             if logconf:
                 os.environ['TRYTOND_LOGGING_CONFIG'] = logconf
 
+            # trytond.application initializes the pools of the databases in
+            # TRYTOND_DATABASE_NAMES itself
             from trytond.application import app
             self.app = app
             self.loaded = True
+
+    def __call__(self, environ, start_response):
+        if not self.loaded:
+            self.load(environ.get('trytond.config'))
         return self.app.wsgi_app(environ, start_response)
 
 
+def is_rpc_request(environ):
+    return (environ.get('REQUEST_METHOD') == 'POST'
+        and 'json' in environ.get('CONTENT_TYPE', ''))
+
+
+def parse_rpc_request(environ):
+    '''
+    Return the JSON-RPC method and params of the request. The body is put
+    back in wsgi.input so the application can read it again.
+    '''
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if not is_rpc_request(environ) or not length:
+        return None, None
+    body = environ['wsgi.input'].read(length)
+    environ['wsgi.input'] = io.BytesIO(body)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, None
+    if not isinstance(data, dict):
+        return None, None
+    return data.get('method'), data.get('params')
+
+
+class Instrumentation(object):
+    '''
+    WSGI middleware that records the latency, response size and status of
+    each JSON-RPC method in an in-memory histogram, written to log_file every
+    interval seconds. Requests slower than slow_threshold seconds are also
+    written with their path, method and the shape of their parameters (the
+    parameters themselves if log_params is set, except for the methods that
+    may carry passwords).
+    '''
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+    # Methods whose parameters are never written
+    SECRET_METHODS = ('login', 'common.db.', 'set_preferences', 'password')
+
+    def __init__(self, app, log_file, interval=60, slow_threshold=None,
+            log_params=False):
+        self.app = app
+        self.log_file = log_file
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.log_params = log_params
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.last_dump = time.time()
+
+    def parse_request(self, environ):
+        # Other requests share one entry, recording each path would let any
+        # client grow the histogram without bound
+        if not is_rpc_request(environ):
+            return 'other', None
+        return parse_rpc_request(environ)
+
+    @classmethod
+    def shape(cls, value):
+        "Return value with its scalars replaced by their type name"
+        if isinstance(value, dict):
+            return dict((k, cls.shape(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [cls.shape(x) for x in value]
+        return type(value).__name__
+
+    def loggable_params(self, method, params):
+        if method and any(x in method for x in self.SECRET_METHODS):
+            return '<hidden>'
+        if not self.log_params:
+            return self.shape(params)
+        return params
+
+    def record(self, method, status, size, elapsed):
+        with self.lock:
+            stats = self.stats.setdefault(method, {
+                    'count': 0,
+                    'total': 0.,
+                    'max': 0.,
+                    'size': 0,
+                    'status': {},
+                    'buckets': [0] * len(self.BUCKETS),
+                    })
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['size'] += size
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            for i, limit in enumerate(self.BUCKETS):
+                if elapsed <= limit:
+                    stats['buckets'][i] += 1
+                    break
+            if time.time() - self.last_dump >= self.interval:
+                self.dump()
+
+    def dump(self):
+        lines = ['# %s' % time.strftime('%Y-%m-%d %H:%M:%S')]
+        for method, stats in sorted(self.stats.items(),
+                key=lambda x: x[1]['total'], reverse=True):
+            lines.append('%s count=%d avg=%.3f max=%.3f avg_size=%d '
+                'status=%s buckets=%s' % (method, stats['count'],
+                    stats['total'] / stats['count'], stats['max'],
+                    stats['size'] / stats['count'],
+                    ','.join('%s:%d' % x for x in sorted(
+                            stats['status'].items())),
+                    ','.join('%s:%d' % (limit, count) for limit, count in
+                        zip(self.BUCKETS, stats['buckets']) if count)))
+        self.write(lines)
+        self.last_dump = time.time()
+
+    def write(self, lines):
+        with open(self.log_file, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        method, params = self.parse_request(environ)
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        size = 0
+        result = self.app(environ, _start_response)
+        try:
+            for chunk in result:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            elapsed = time.time() - start
+            self.record(method or 'unknown', status[0] if status else '-',
+                size, elapsed)
+            if self.slow_threshold and elapsed >= self.slow_threshold:
+                params = self.loggable_params(method, params)
+                self.write(['SLOW %.3fs %s %s %s' % (elapsed,
+                            environ.get('PATH_INFO', ''), method,
+                            json.dumps(params, default=repr))])
+
+
+def accepted_encodings(environ):
+    encodings = set()
+    for value in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = value.partition(';')
+        quality = 1
+        for param in params.split(';'):
+            key, _, param_value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0
+        # q=0 means the encoding is not acceptable
+        if quality > 0:
+            encodings.add(name.strip().lower())
+    result = []
+    if brotli and 'br' in encodings:
+        result.append('br')
+    if 'gzip' in encodings:
+        result.append('gzip')
+    return result
+
+
+class Compression(object):
+    '''
+    WSGI middleware that compresses JSON responses bigger than min_size
+    bytes with brotli (if installed) or gzip, depending on what the client
+    accepts. Only those responses are buffered, the rest are passed through
+    as they are produced.
+    '''
+    def __init__(self, app, min_size=1024, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        encodings = accepted_encodings(environ)
+        if not encodings:
+            return self.app(environ, start_response)
+
+        response = {}
+
+        def _start_response(status, headers, exc_info=None):
+            names = dict((k.lower(), v) for k, v in headers)
+            length = names.get('content-length')
+            if ('json' not in names.get('content-type', '')
+                    or 'content-encoding' in names
+                    or (length and length.isdigit()
+                        and int(length) < self.min_size)):
+                response['body'] = None
+                return start_response(status, headers, exc_info)
+            response.update(status=status, headers=headers,
+                exc_info=exc_info, body=[])
+            return response['body'].append
+
+        result = self.app(environ, _start_response)
+        if 'body' in response and response['body'] is None:
+            return result
+        return self.compress(result, response, encodings[0], start_response)
+
+    def compress(self, result, response, encoding, start_response):
+        try:
+            for chunk in result:
+                if response.get('body') is None:
+                    yield chunk
+                else:
+                    response['body'].append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if response.get('body') is None:
+            return
+
+        body = b''.join(response['body'])
+        headers = response['headers']
+        if len(body) >= self.min_size:
+            if encoding == 'br':
+                body = brotli.compress(body, quality=self.level)
+            else:
+                body = gzip.compress(body, compresslevel=self.level)
+            headers = [(k, v) for k, v in headers
+                if k.lower() != 'content-length']
+            headers.extend([
+                    ('Content-Encoding', encoding),
+                    ('Content-Length', str(len(body))),
+                    ('Vary', 'Accept-Encoding'),
+                    ])
+        start_response(response['status'], headers, response['exc_info'])
+        yield body
+
+
+class StaticFiles(object):
+    '''
+    WSGI middleware that serves the files of root (the SAO directory) under
+    prefix. Files pre-compressed by the sao.compress task (.br and .gz) are
+    sent when the client accepts them. Responses have an ETag computed from
+    the content, with the encoding appended for the compressed variants, and
+    are validated with If-None-Match. Files with a content
+    hash in their name are cached for a year, the rest must be revalidated.
+
+    Only the files and directories of served are sent, and never a path
+    with a segment starting with a dot, so the checkout metadata, package
+    files and node_modules are not exposed.
+    '''
+    SERVED = ('index.html', 'custom.js', 'custom.css', 'dist', 'images',
+        'locale', 'bower_components')
+    HASHED = re.compile(r'[.-][0-9a-f]{8,}\.')
+    ENCODING_SUFFIX = {
+        'br': '.br',
+        'gzip': '.gz',
+        }
+
+    def __init__(self, app, root, prefix='/', served=None):
+        self.app = app
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        self.served = served or self.SERVED
+        self.etags = {}
+
+    def get_path(self, environ):
+        path_info = environ.get('PATH_INFO', '')
+        if (environ.get('REQUEST_METHOD') not in ('GET', 'HEAD')
+                or not path_info.startswith(self.prefix)):
+            return
+        path = path_info[len(self.prefix):].lstrip('/') or 'index.html'
+        segments = path.split('/')
+        if (segments[0] not in self.served
+                or any(x.startswith('.') for x in segments)):
+            return
+        path = os.path.abspath(os.path.join(self.root, path))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return
+        return path
+
+    def get_etag(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        if key not in self.etags:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            self.etags[key] = '"%s"' % digest.hexdigest()
+        return self.etags[key]
+
+    def __call__(self, environ, start_response):
+        path = self.get_path(environ)
+        if not path:
+            return self.app(environ, start_response)
+
+        etag = self.get_etag(path)
+        if self.HASHED.search(os.path.basename(path)):
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'public, no-cache'
+        content_type, _ = mimetypes.guess_type(path)
+        headers = [
+            ('Cache-Control', cache_control),
+            ('Vary', 'Accept-Encoding'),
+            ]
+        # Each variant has its own ETag as their bytes differ
+        filename = path
+        for encoding in accepted_encodings(environ):
+            compressed = path + self.ENCODING_SUFFIX[encoding]
+            if (os.path.isfile(compressed) and os.path.getmtime(compressed)
+                    >= os.path.getmtime(path)):
+                filename = compressed
+                etag = '%s-%s"' % (etag[:-1], encoding)
+                headers.append(('Content-Encoding', encoding))
+                break
+        headers.append(('ETag', etag))
+        if self.matches(etag, environ.get('HTTP_IF_NONE_MATCH', '')):
+            start_response('304 Not Modified', headers)
+            return []
+
+        path = filename
+        headers.append(('Content-Type',
+                content_type or 'application/octet-stream'))
+        headers.append(('Content-Length', str(os.path.getsize(path))))
+        start_response('200 OK', headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        wrapper = environ.get('wsgi.file_wrapper')
+        if wrapper:
+            return wrapper(open(path, 'rb'), 65536)
+        return self.read(path)
+
+    @staticmethod
+    def matches(etag, if_none_match):
+        for value in if_none_match.split(','):
+            value = value.strip()
+            if value.startswith('W/'):
+                value = value[2:]
+            if value in (etag, '*'):
+                return True
+        return False
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                yield chunk
+
+
+class Dispatcher(object):
+    '''
+    WSGI middleware to serve many small tenants from the same workers.
+
+    mapping links a Host header or a path prefix (starting with "/") to the
+    database of the tenant. trytond's configuration is global to the
+    process, so tenants share the configuration and are isolated by
+    database: requests whose first path segment is not the database of the
+    tenant are rejected, except GET and HEAD requests to the non database
+    paths of allowed (the root and the SAO assets by default) and calls to
+    the root_methods, which do not give access to any database. Only the
+    pools of the max_tenants most recently used databases are kept in
+    memory and pools idle for more than idle_timeout seconds are released
+    too.
+    '''
+    ALLOWED = ('', 'favicon.ico') + StaticFiles.SERVED
+    ROOT_METHODS = ('common.server.version', 'common.server.listlang')
+
+    def __init__(self, app, mapping, max_tenants=10, idle_timeout=3600,
+            allowed=None, root_methods=None):
+        self.app = app
+        self.allowed = set(allowed if allowed is not None else self.ALLOWED)
+        self.root_methods = set(root_methods if root_methods is not None
+            else self.ROOT_METHODS)
+        self.hosts = dict((k, v) for k, v in mapping.items()
+            if not k.startswith('/'))
+        # Longest prefixes first so nested prefixes are matched correctly
+        self.prefixes = sorted(((k.rstrip('/'), v) for k, v in mapping.items()
+                if k.startswith('/')), key=lambda x: len(x[0]), reverse=True)
+        self.max_tenants = max_tenants
+        self.idle_timeout = idle_timeout
+        self.tenants = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, app, filename, **kwargs):
+        '''
+        Create the dispatcher from the [tenants] section of filename
+        '''
+        parser = configparser.ConfigParser()
+        parser.optionxform = str
+        parser.read(filename)
+        return cls(app, dict(parser.items('tenants')), **kwargs)
+
+    def get_tenant(self, environ):
+        host = environ.get('HTTP_HOST', '').split(':')[0]
+        if host in self.hosts:
+            return self.hosts[host], None
+        path = environ.get('PATH_INFO', '')
+        for prefix, database in self.prefixes:
+            if path == prefix or path.startswith(prefix + '/'):
+                return database, prefix
+        return None, None
+
+    def touch(self, database):
+        from trytond.pool import Pool
+        with self.lock:
+            now = time.time()
+            self.tenants.pop(database, None)
+            self.tenants[database] = now
+            evict = [db for db, last in self.tenants.items()
+                if now - last > self.idle_timeout]
+            for db in self.tenants:
+                if len(self.tenants) - len(evict) <= self.max_tenants:
+                    break
+                if db not in evict:
+                    evict.append(db)
+            for db in evict:
+                del self.tenants[db]
+                Pool.stop(db)
+
+    def __call__(self, environ, start_response):
+        database, prefix = self.get_tenant(environ)
+        if database is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Unknown tenant']
+        if prefix:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+            environ['PATH_INFO'] = environ['PATH_INFO'][len(prefix):]
+
+        # Tryton clients send the database as first segment of the path
+        requested = environ.get('PATH_INFO', '').lstrip('/').split('/')[0]
+        if requested == database:
+            self.touch(database)
+        elif not self.allowed_request(environ, requested):
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return [b'Forbidden']
+        return self.app(environ, start_response)
+
+    def allowed_request(self, environ, requested):
+        if requested not in self.allowed:
+            return False
+        if environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            return True
+        # Root calls like common.db.list would show the other databases
+        return (requested == '' and is_rpc_request(environ)
+            and parse_rpc_request(environ)[0] in self.root_methods)
+
+
+class Profiler(object):
+    '''
+    Sampling profiler for a running worker. While enabled, the stacks of all
+    threads are sampled every interval seconds and counted in collapsed
+    stack format (one "frame;frame;frame count" line per stack, as read by
+    flamegraph.pl) in output. Nothing runs while it is disabled.
+
+    It can be switched on and off by sending toggle_signal (SIGUSR2 by
+    default) to the worker. As Python only runs signal handlers on the main
+    thread, which does not serve requests under mod_wsgi, the samples are
+    taken from a background thread.
+    '''
+    def __init__(self, output, interval=0.005, toggle_signal=signal.SIGUSR2):
+        self.output = output
+        self.interval = interval
+        self.stacks = {}
+        self.thread = None
+        self.enabled = False
+        try:
+            signal.signal(toggle_signal, self.toggle)
+        except ValueError:
+            # Not in the main thread
+            pass
+        atexit.register(self.stop)
+
+    def toggle(self, signum=None, frame=None):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.thread.join()
+        self.dump()
+
+    def run(self):
+        ident = threading.get_ident()
+        while self.enabled:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        with open(self.output, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
 # WSGI standard requires the variable to be named 'application' and mod_wsgi
 # does not allow that value to be overriden.
 application = Application()
+
+# Preload when the configuration is known at import time
+_config_file = get_config_file()
+if _config_file:
+    application.load(_config_file)
+
+if os.environ.get('TRYTOND_WSGI_COMPRESS_MIN_SIZE'):
+    application = Compression(application,
+        min_size=int(os.environ['TRYTOND_WSGI_COMPRESS_MIN_SIZE']))
+
+if os.environ.get('TRYTOND_WSGI_SAO_ROOT'):
+    application = StaticFiles(application, os.environ['TRYTOND_WSGI_SAO_ROOT'],
+        prefix=os.environ.get('TRYTOND_WSGI_SAO_PREFIX', '/'))
+
+if os.environ.get('TRYTOND_WSGI_TENANTS'):
+    application = Dispatcher.from_file(application,
+        os.environ['TRYTOND_WSGI_TENANTS'],
+        max_tenants=int(os.environ.get('TRYTOND_WSGI_MAX_TENANTS', 10)),
+        idle_timeout=float(os.environ.get('TRYTOND_WSGI_TENANT_IDLE', 3600)))
+
+if os.environ.get('TRYTOND_WSGI_STATS'):
+    application = Instrumentation(application,
+        os.environ['TRYTOND_WSGI_STATS'],
+        interval=float(os.environ.get('TRYTOND_WSGI_STATS_INTERVAL', 60)),
+        slow_threshold=float(os.environ.get('TRYTOND_WSGI_SLOW_THRESHOLD', 0))
+        or None,
+        log_params=bool(os.environ.get('TRYTOND_WSGI_SLOW_PARAMS')))
+
+# The profiler writes one file per worker
+if os.environ.get('TRYTOND_WSGI_PROFILE'):
+    profiler = Profiler('%s.%d' % (os.environ['TRYTOND_WSGI_PROFILE'],
+            os.getpid()),
+        interval=float(os.environ.get('TRYTOND_WSGI_PROFILE_INTERVAL',
+                0.005)))
+    if os.environ.get('TRYTOND_WSGI_PROFILE_ENABLED'):
+        profiler.start()